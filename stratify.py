@@ -3,10 +3,38 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-from subprocess import run
-from sys import exit, argv
-from argparse import ArgumentParser
-from os.path import basename, join, exists, isabs
+from subprocess import run, CompletedProcess, Popen, DEVNULL, STDOUT
+from sys import exit, argv, executable
+from argparse import ArgumentParser, SUPPRESS
+from os.path import (
+    basename,
+    dirname,
+    join,
+    exists,
+    isabs,
+    lexists,
+    realpath,
+    relpath
+)
+from ctypes import CDLL, get_errno
+from stat import S_ISBLK
+from random import Random
+from mmap import mmap
+from fcntl import ioctl, flock, LOCK_EX
+from struct import pack
+from errno import ENXIO
+from gzip import compress as gzip_compress
+from hashlib import sha1, sha256
+from threading import Thread, Condition, Event, Lock
+from base64 import b64decode, b64encode
+from queue import Queue
+from urllib.request import urlopen
+from socketserver import StreamRequestHandler, ThreadingUnixStreamServer
+from atexit import register as atexit_register
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep, strftime, time
+from statistics import median
+from tempfile import mkdtemp, mkstemp
 from os import (
     environ,
     mkdir,
@@ -14,13 +42,38 @@ from os import (
     chroot,
     chdir,
     listdir,
+    O_DIRECT,
+    O_RDONLY,
+    O_WRONLY,
+    SEEK_DATA,
+    SEEK_END,
+    SEEK_HOLE,
+    close,
+    cpu_count,
+    lseek,
+    makedev,
+    makedirs,
+    open as os_open,
+    pipe,
+    pread,
+    preadv,
+    pwrite,
+    rename,
+    stat,
+    statvfs,
+    strerror,
+    urandom,
+    utime,
     unlink,
     symlink,
+    sync,
     fdatasync
 )
 import traceback
 import logging
 import shutil
+import tarfile
+import json
 import re
 
 _version = "1.2"
@@ -35,6 +88,14 @@ fs_name = "fs1"
 # Default Fedora repository URL
 repo_fmt = "https://mirrors.mit.edu/fedora/linux/releases/%s/Server/x86_64/os/"
 
+# Candidate Fedora repository mirrors probed when no --repo is given
+mirror_fmts = [
+    repo_fmt,
+    "https://dl.fedoraproject.org/pub/fedora/linux/releases/%s/Server/"
+    "x86_64/os/",
+    "https://mirrors.kernel.org/fedora/releases/%s/Server/x86_64/os/",
+]
+
 # Default location of the target system root directory
 sys_root = "/mnt/stratisroot"
 
@@ -50,6 +111,103 @@ BIOS_BOOT_SIZE = 1
 # Default size of the /boot partition
 BOOT_PART_SIZE = 1000
 
+# Size of the file read by --cache-benchmark (MiB), and the number, size
+# and passes of the random reads issued.
+BENCH_SIZE = 256
+BENCH_READS = 8192
+BENCH_BLOCK_SIZE = 4096
+BENCH_PASSES = 3
+
+# Size of the loop device file systems used by --tuning-benchmark (MiB) and
+# the number and size of the files written by the benchmark workload.
+BENCH_FS_SIZE = 512
+BENCH_FILES = 2000
+BENCH_FILE_SIZE = 16384
+
+# Size of the regions at the start and end of each device that are zeroed
+# when wiping signatures (bytes).
+WIPE_REGION_SIZE = 2**20
+
+# Interval between progress reports (seconds) and the number of past
+# durations kept for each install phase.
+PROGRESS_INTERVAL = 30
+HISTORY_SIZE = 10
+
+# Minimum average busy or stalled percentage at which a resource is
+# reported as the bottleneck of an install phase.
+BOTTLENECK_THRESHOLD = 25
+
+# Size of the chunks compressed in parallel when exporting a disk image
+EXPORT_CHUNK_SIZE = 4 * 2**20
+
+# Preflight check limits: the installed memory needed by anaconda for a
+# Live media installation, the minimum size of the pool device on the
+# boot disk and of other pool devices (MiB), and the repository request
+# timeout (seconds).
+ANACONDA_MEM_NEED = 3072
+MIN_POOL_SIZE = 4096
+MIN_BLOCKDEV_SIZE = 1024
+PREFLIGHT_TIMEOUT = 2
+
+# Mirror probe request timeout and lifetime of the cached mirror
+# selection (seconds).
+MIRROR_TIMEOUT = 5
+MIRROR_CACHE_TTL = 3600
+
+# Block device ioctl requests from linux/fs.h
+BLKDISCARD = 0x1277
+
+# Memory reserved for the Live environment and anaconda when sizing the
+# Live /run tmpfs (MiB).
+LIVE_MEM_RESERVE = 2048
+
+# Estimated space needed in the Live /run tmpfs for host packages and the
+# anaconda runtime, the dnf cache, the --git-host build dependencies,
+# a stratis git build tree and the compiler cache (MiB).
+LIVE_BASE_NEED = 1024
+LIVE_DNF_CACHE_NEED = 512
+LIVE_BUILD_DEPS_NEED = 1536
+LIVE_GIT_BUILD_NEED = 3072
+LIVE_BUILD_CACHE_NEED = 2048
+
+# Memory needed by each parallel git build job (MiB).
+BUILD_JOB_MEM = 1024
+
+# Compression level of --host-overlay archives: favour capture speed.
+OVERLAY_COMPRESS_LEVEL = 1
+
+# Maximum total size of the images in the initramfs cache (MiB).
+INITRAMFS_CACHE_SIZE = 1024
+
+# Location of the spill directory in the target root used for large
+# scratch areas when the Live system is short of memory.
+spill_dir = "var/tmp/stratify"
+
+# Location of the package prefetch dnf cache in the target root
+prefetch_cache_dir = join(spill_dir, "prefetch-cache")
+
+# Host directory for stratify run-time data
+stratify_run_dir = "/run/stratify"
+
+# Directory for persistent stratify state
+state_dir = "/var/lib/stratify"
+
+# Default path of the --daemon socket
+daemon_socket = "/run/stratify.sock"
+
+# Location of the host git build directory
+git_basedir = join("/", "root", "git")
+
+# Default persistent compiler cache directory shared by the host and
+# target git builds
+build_cache_dir = "/var/cache/stratify/build"
+
+# Default initramfs cache directory
+initramfs_cache_dir = "/var/cache/stratify/initramfs"
+
+# Directory of the ccache compiler wrapper links
+ccache_libdir = "/usr/lib64/ccache"
+
 # Regular expression to match UUID
 UUID_REGEX = r"\S{8}-\S{4}-\S{4}-\S{4}-\S{12}"
 
@@ -65,11 +223,37 @@ host_package_deps_stratis = [
     "stratis-cli",
 ]
 
+# Host account files modified by package scriptlets: the entries added
+# by the packages in a --host-overlay archive are merged into these
+host_overlay_files = [
+    "/etc/passwd",
+    "/etc/group",
+    "/etc/shadow",
+    "/etc/gshadow"
+]
+
+# Directories holding state written by package scriptlets that is saved
+# with the host dependency overlay
+host_overlay_dirs = [
+    "/etc/alternatives",
+    "/var/lib/alternatives"
+]
+
+# Commands replaying the effect of package scriptlets on the running host
+# after the host dependency overlay is restored
+host_overlay_reload_cmds = [
+    ["ldconfig"],
+    ["systemctl", "daemon-reload"],
+    ["systemd-tmpfiles", "--create"],
+    ["udevadm", "control", "--reload"]
+]
+
 # Packages needed to build from git
 # Package list taken from dkeefe's script
 build_deps = [
     "asciidoc",
     "cargo",
+    "ccache",
     "clang",
     "cryptsetup-devel",
     "cryptsetup-libs",
@@ -108,6 +292,7 @@ build_deps = [
     "rpmdevtools",
     "rust",
     # "rust-toolset",
+    "sccache",
     "systemd-devel",
     "systemd-devel.x86_64",
     "xfsprogs",
@@ -115,6 +300,32 @@ build_deps = [
     "clevis-luks"
 ]
 
+# Packages that must be installed for the initramfs cache to be used,
+# and configuration files whose contents, together with the versions of
+# all installed packages, key the initramfs cache
+initramfs_deps = [
+    "dracut",
+    "stratisd",
+    "stratisd-dracut"
+]
+
+initramfs_conf = [
+    "etc/dracut.conf",
+    "etc/fstab",
+    "etc/crypttab",
+    "etc/locale.conf",
+    "etc/vconsole.conf"
+]
+
+# Packages upgraded by --update in addition to the Stratis and boot
+# loader packages
+update_deps = [
+    "kernel",
+    "kernel-core",
+    "kernel-modules",
+    "dracut"
+]
+
 boot_deps = [
     "boom-boot"
 ]
@@ -156,6 +367,78 @@ package_deps_stratis = [
     "stratis-cli",
 ]
 
+# Template for the EFI grub.cfg stub redirecting to /boot/grub2/grub.cfg
+grub_stub = """\
+search --no-floppy --fs-uuid --set=dev %s
+set prefix=($dev)/grub2
+export $prefix
+configfile $prefix/grub.cfg
+"""
+
+# Template for the BLS enabled /boot/grub2/grub.cfg written by
+# render_boot_config(). Boot entries are read from /loader/entries on the
+# /boot file system by the blscfg command.
+grub_cfg = """\
+# Generated by stratify.py %(version)s
+set pager=1
+
+if [ -f ${config_directory}/grubenv ]; then
+  load_env -f ${config_directory}/grubenv
+elif [ -s $prefix/grubenv ]; then
+  load_env
+fi
+if [ "${next_entry}" ] ; then
+   set default="${next_entry}"
+   set next_entry=
+   save_env next_entry
+   set boot_once=true
+else
+   set default="${saved_entry}"
+fi
+
+if [ x"${feature_menuentry_id}" = xy ]; then
+  menuentry_id_option="--id"
+else
+  menuentry_id_option=""
+fi
+export menuentry_id_option
+
+terminal_output console
+set timeout_style=menu
+set timeout=5
+
+insmod part_gpt
+insmod xfs
+search --no-floppy --fs-uuid --set=boot %(boot_uuid)s
+set root=$boot
+insmod blscfg
+blscfg
+"""
+
+# Block queue limits read from sysfs to tune mkfs and mount options and
+# to decide whether a device can be discarded
+queue_limits = [
+    "optimal_io_size",
+    "minimum_io_size",
+    "rotational",
+    "discard_max_bytes"
+]
+
+# Fields of the --sample resource usage time series
+sample_fields = [
+    "time",
+    "phase",
+    "cpu",
+    "iowait",
+    "mem_used",
+    "psi_cpu",
+    "psi_memory",
+    "psi_io",
+    "read_mibs",
+    "write_mibs",
+    "disk_util"
+]
+
 chroot_bind_mounts = [
     "dev",
     "proc",
@@ -175,6 +458,50 @@ _log_info = _log.info
 _log_warn = _log.warning
 _log_error = _log.error
 
+# C library handle for the mount(2) and umount2(2) system calls
+_libc = CDLL(None, use_errno=True)
+
+MS_BIND = 4096
+
+# Cached mount table, see get_mountinfo(), and the lock serialising
+# updates from concurrent umount() calls
+_mountinfo = None
+_mountinfo_lock = Lock()
+
+# Install phase timing: a list of [NAME, START, END] entries for the phases
+# of the current run, and the optional --phase-log path.
+_phases = []
+_phase_log = None
+
+# Provisioning daemon state: all jobs by id, the queue of jobs waiting for
+# a worker, the running jobs, the number of exclusive jobs waiting to run
+# and the condition protecting them.
+_daemon_jobs = {}
+_daemon_queue = Queue()
+_daemon_running = []
+_daemon_exclusive_waiting = 0
+_daemon_cond = Condition()
+
+# Background package prefetch: the worker thread, a dictionary mapping
+# each dependency type to the list of downloaded package files and the
+# staging directories to remove.
+_prefetch_thread = None
+_prefetch_rpms = {}
+_prefetch_dirs = []
+
+# Resource sampler thread, target devices sampled and per-phase totals
+_sampler = None
+_sample_stop = Event()
+_sample_devices = []
+_sample_totals = {}
+_sample_counts = {}
+
+# Number of dnf runs skipped because all packages were installed
+_dnf_runs_avoided = 0
+
+# Chroot servers: maps root directory to a dictionary describing the server
+_chroot_servers = {}
+
 
 def fail(rc):
     if _debug:
@@ -182,6 +509,18 @@ def fail(rc):
     exit(rc)
 
 
+def parallel(calls):
+    """Run each (FUNCTION, ARGS) tuple in ``calls`` in its own thread and
+    return the list of results in the same order. Exceptions, including
+    the ``SystemExit`` raised by ``fail()``, are re-raised in the caller.
+    """
+    if len(calls) < 2:
+        return [fn(*args) for (fn, args) in calls]
+    with ThreadPoolExecutor(max_workers=len(calls)) as executor:
+        futures = [executor.submit(fn, *args) for (fn, args) in calls]
+        return [future.result() for future in futures]
+
+
 def whole_disk(name):
     """Return ``True`` if the string ``dev`` corresponds to a whole disk
     device, or ``False`` otherwise.
@@ -190,6 +529,10 @@ def whole_disk(name):
         return not name[-1].isdigit()
     if name.startswith("mpath"):
         return not name[name.rindex('p') + 1].isdigit()
+    if name.startswith("loop"):
+        return "p" not in name[len("loop"):]
+    if name.startswith("nvme"):
+        return re.match(r"^nvme\d+n\d+$", name) is not None
 
 
 def filter_device(name):
@@ -197,7 +540,7 @@ def filter_device(name):
     name prefixes, or ``False`` otherwise.
     """
     # Allowed device name prefixes
-    dev_filter = ["sd", "vd", "mpath"]
+    dev_filter = ["sd", "vd", "mpath", "loop", "nvme"]
     for df in dev_filter:
         if name.startswith(df):
             return True
@@ -218,7 +561,8 @@ def get_partitions(name):
     """Return a list of partition device names.
     """
     all_devs = get_devices()
-    parts = [d for d in all_devs if d.startswith(name) and d != name]
+    prefix = get_partition_device(name, 0)[:-1]
+    parts = [d for d in all_devs if d.startswith(prefix) and d != name]
     return parts
 
 
@@ -226,7 +570,7 @@ def get_partition_device(name, partnum):
     """Format a device name with a partition number according to the
     convention for the corresponding device type.
     """
-    if name.startswith("mpath"):
+    if name.startswith(("mpath", "loop", "nvme")):
         return "%sp%d" % (name, partnum)
     else:
         return "%s%d" % (name, partnum)
@@ -276,15 +620,200 @@ def check_target(target):
     return True
 
 
+def get_device_size(name):
+    """Return the size of the block device ``name`` in MiB, or zero if it
+    cannot be read.
+    """
+    try:
+        with open(join("/sys/class/block", name, "size"), "r") as size:
+            return int(size.read().strip()) * 512 // 2**20
+    except (OSError, ValueError):
+        return 0
+
+
+def check_kickstart(kickstart):
+    """Return a list of problems found in the kickstart file ``kickstart``.
+    """
+    try:
+        with open(kickstart, "r", encoding="utf8") as ks:
+            lines = [line.strip() for line in ks.read().splitlines()]
+    except OSError as err:
+        return ["Cannot read kickstart %s: %s" % (kickstart, err.strerror)]
+    problems = []
+    sections = [line.split()[0] for line in lines if line.startswith("%")]
+    sections = [section for section in sections
+                if section not in ("%end", "%include", "%ksappend")]
+    if "%packages" not in sections:
+        problems.append("Kickstart %s has no %%packages section" % kickstart)
+    if len(sections) != lines.count("%end"):
+        problems.append("Kickstart %s has unterminated sections (%d "
+                        "sections, %d %%end)" %
+                        (kickstart, len(sections), lines.count("%end")))
+    return problems
+
+
+def check_repo(repo_url):
+    """Return a list of problems found fetching the metadata of the
+    repository at ``repo_url``.
+    """
+    repomd_url = repo_url.rstrip("/") + "/repodata/repomd.xml"
+    try:
+        with urlopen(repomd_url, timeout=PREFLIGHT_TIMEOUT) as repomd:
+            repomd.read(1)
+    except (OSError, ValueError) as err:
+        return ["Repository %s is not reachable: %s" % (repo_url, err)]
+    return []
+
+
+def get_installed_memory():
+    """Return the size of the online memory blocks in MiB. This is the
+    installed memory, unlike MemTotal which excludes memory reserved by
+    the kernel. Falls back to MemTotal if the memory blocks cannot be
+    read.
+    """
+    memory_path = "/sys/devices/system/memory"
+    try:
+        with open(join(memory_path, "block_size_bytes"), "r") as f:
+            block_size = int(f.read().strip(), 16)
+        online = 0
+        for name in listdir(memory_path):
+            if not re.match(r"^memory\d+$", name):
+                continue
+            with open(join(memory_path, name, "online"), "r") as f:
+                online += int(f.read().strip())
+        if online:
+            return online * block_size // 2**20
+    except (OSError, ValueError):
+        pass
+    return get_meminfo()["MemTotal"] // 1024
+
+
+def check_memory():
+    """Return a list of problems with the memory available to anaconda.
+    """
+    mem_total = get_installed_memory()
+    if mem_total < ANACONDA_MEM_NEED:
+        return ["Insufficient memory for anaconda: %dMiB (need %dMiB)" %
+                (mem_total, ANACONDA_MEM_NEED)]
+    return []
+
+
+def check_target_sizes(targets, efi, image_size=None):
+    """Return a list of problems with the sizes of the ``targets``: the
+    first must hold the boot partitions and a minimum sized pool device.
+    If ``image_size`` is set the first target is a disk image of that
+    many bytes that has not been created yet and ``targets`` must be
+    empty.
+    """
+    problems = []
+    need = (EFI_PART_SIZE if efi else BIOS_BOOT_SIZE) + BOOT_PART_SIZE
+    need += MIN_POOL_SIZE
+    if image_size:
+        if image_size // 2**20 < need:
+            problems.append("Disk image is too small: %dMiB (need %dMiB)" %
+                            (image_size // 2**20, need))
+        need = MIN_BLOCKDEV_SIZE
+    for target in targets:
+        size = get_device_size(target)
+        if size < need:
+            problems.append("Target device %s is too small: %dMiB (need "
+                            "%dMiB)" % (target, size, need))
+        need = MIN_BLOCKDEV_SIZE
+    return problems
+
+
+def check_pool_name(pool):
+    """Return a list of problems if the stratis ``pool`` already exists,
+    starting stratisd with ``start_stratisd()`` if it is not running.
+    """
+    if not stratisd_running():
+        start_stratisd()
+    if pool in list_stratis_objects():
+        return ["Pool %s already exists: use --wipe to destroy it" % pool]
+    return []
+
+
+def _report_preflight(problems, start):
+    """Log each of the preflight ``problems`` and fail if there are any,
+    otherwise log the time taken since ``start``.
+    """
+    for problem in problems:
+        _log_error("Preflight: %s" % problem)
+    if problems:
+        fail(1)
+    _log_info("Preflight checks passed in %.1fs" % (time() - start))
+
+
+def preflight(kickstart, repo_url, targets, efi, partition=True,
+              image_size=None):
+    """Check the install configuration concurrently before the host
+    dependencies are installed: the ``kickstart`` file, the repository at
+    ``repo_url``, the available memory and, if ``partition`` is ``True``,
+    the sizes of the ``targets`` or of the disk image to be created with
+    ``image_size`` bytes. All problems found are logged before failing.
+    """
+    checks = [(check_repo, (repo_url,)), (check_memory, ())]
+    if kickstart:
+        checks.append((check_kickstart, (kickstart,)))
+    if partition:
+        checks.append((check_target_sizes, (targets, efi, image_size)))
+    start = time()
+    problems = []
+    for result in parallel(checks):
+        problems.extend(result)
+    _report_preflight(problems, start)
+
+
+def preflight_pool(pool):
+    """Check that the stratis ``pool`` does not already exist. This runs
+    once the host dependencies, including stratisd, are installed.
+    """
+    start = time()
+    _report_preflight(check_pool_name(pool), start)
+
+
+def missing_packages(deps, chroot=None):
+    """Return the list of packages in ``deps`` that are not installed in
+    either the host system or the chroot, using a single rpm query. All
+    of ``deps`` are returned if the query fails for another reason.
+    """
+    rpm_cmd = ["rpm", "-q", "--queryformat", ""]
+    rpm_cmd.extend(deps)
+    if not chroot:
+        rpm_run = run(rpm_cmd, capture_output=True)
+    else:
+        rpm_run = runat(rpm_cmd, chroot, "/", capture_output=True)
+    missing = []
+    for line in rpm_run.stdout.decode("utf8").splitlines():
+        match = re.match(r"package (\S+) is not installed", line)
+        if match:
+            missing.append(match.group(1))
+    if rpm_run.returncode != 0 and not missing:
+        _log_warn("Failed to query installed packages: %s" %
+                  rpm_run.stderr.decode("utf8").strip())
+        return list(deps)
+    return missing
+
+
 def install_deps(deps, deptype, chroot=None):
     """Install the list of package dependencies given in ``deps`` in either
-    the host system or the chroot using dnf.
+    the host system or the chroot using dnf. Chroot installs use packages
+    prefetched for ``deptype`` if available.
     """
+    global _dnf_runs_avoided
     _log_info("Installing %s dependencies%s" %
               (deptype, " in chroot" if chroot else ""))
     _log_debug("Package list: %s", ", ".join(deps))
+    missing = missing_packages(deps, chroot=chroot)
+    if not missing:
+        _log_info("All %s dependencies are already installed" % deptype)
+        _dnf_runs_avoided += 1
+        return
+    _log_debug("Missing packages: %s", ", ".join(missing))
+    if chroot and install_prefetched(deptype, chroot):
+        return
     pkg_cmd = ["dnf", "-y", "install"]
-    pkg_cmd.extend(deps)
+    pkg_cmd.extend(missing)
     if not chroot:
         pkg_run = run(pkg_cmd)
     else:
@@ -294,44 +823,429 @@ def install_deps(deps, deptype, chroot=None):
         fail(1)
 
 
+def get_host_packages():
+    """Return the set of NEVRA strings of the packages installed in the
+    host system.
+    """
+    rpm_run = run(["rpm", "-qa"], capture_output=True)
+    if rpm_run.returncode != 0:
+        _log_error("Failed to list installed host packages")
+        fail(1)
+    return set(rpm_run.stdout.decode('utf8').split())
+
+
+def _packages_hash(packages):
+    """Return the SHA-256 hex digest of the list or set of ``packages``.
+    """
+    return sha256(" ".join(sorted(packages)).encode("utf8")).hexdigest()
+
+
+def host_overlay_path(overlay_dir, version, deps, baseline):
+    """Return the path of the host dependency overlay archive in
+    ``overlay_dir`` for Fedora ``version``, the package list ``deps`` and
+    the set of host packages ``baseline`` installed before ``deps``.
+    """
+    return join(overlay_dir, "host-deps-%s-%s-%s.tar.gz" %
+                (version, _packages_hash(deps)[:16],
+                 _packages_hash(baseline)[:16]))
+
+
+def merge_account_file(path, entries):
+    """Append the lines in ``entries`` for accounts that are not present in
+    the colon separated account file at ``path``.
+    """
+    with open(path, "r", encoding="utf8") as account_file:
+        contents = account_file.read()
+    names = {line.split(":")[0] for line in contents.splitlines()}
+    added = [line for line in entries if line.split(":")[0] not in names]
+    if not added:
+        return
+    _log_debug("Adding %s entries to %s" %
+               (", ".join(line.split(":")[0] for line in added), path))
+    with open(path, "a", encoding="utf8") as account_file:
+        if contents and not contents.endswith("\n"):
+            account_file.write("\n")
+        account_file.write("".join(line + "\n" for line in added))
+
+
+def restore_host_overlay(overlay_dir, version, deps, baseline):
+    """Restore the host dependency overlay for Fedora ``version`` and the
+    package list ``deps`` from ``overlay_dir`` and verify that all of the
+    packages are installed. The overlay is only restored if it was saved
+    on a host with the same set of packages ``baseline`` installed. The
+    account entries in the overlay are merged into the host account
+    files and the library cache, systemd and udev configuration are
+    reloaded. Returns ``True`` on success.
+    """
+    overlay_path = host_overlay_path(overlay_dir, version, deps, baseline)
+    if not exists(overlay_path):
+        prefix = "host-deps-%s-%s-" % (version, _packages_hash(deps)[:16])
+        if exists(overlay_dir) and any(name.startswith(prefix) for name
+                                       in listdir(overlay_dir)):
+            _log_warn("Host dependency overlay in %s was saved on a host "
+                      "with different packages installed: not restoring" %
+                      overlay_dir)
+        else:
+            _log_info("No host dependency overlay found at %s" %
+                      overlay_path)
+        return False
+    _log_info("Restoring host dependency overlay %s" % overlay_path)
+    start = time()
+    try:
+        with tarfile.open(overlay_path, "r:gz") as overlay:
+            members = []
+            accounts = {}
+            for member in overlay.getmembers():
+                if member.name.startswith("accounts/"):
+                    account_file = overlay.extractfile(member)
+                    accounts[member.name[len("accounts"):]] = \
+                        account_file.read().decode("utf8").splitlines()
+                else:
+                    members.append(member)
+            if hasattr(tarfile, "fully_trusted_filter"):
+                overlay.extractall("/", members=members, numeric_owner=True,
+                                   filter="fully_trusted")
+            else:
+                overlay.extractall("/", members=members, numeric_owner=True)
+        for (path, entries) in accounts.items():
+            merge_account_file(path, entries)
+    except (OSError, UnicodeDecodeError, tarfile.TarError) as err:
+        _log_warn("Failed to restore host dependency overlay: %s" % err)
+        return False
+    for reload_cmd in host_overlay_reload_cmds:
+        try:
+            reload_run = run(reload_cmd, capture_output=True)
+            err = reload_run.stderr.decode('utf8').strip()
+            failed = reload_run.returncode != 0
+        except OSError as os_err:
+            (err, failed) = (os_err, True)
+        if failed:
+            _log_warn("Failed to run '%s' after restoring host dependency "
+                      "overlay: %s" % (" ".join(reload_cmd), err))
+            return False
+    missing = missing_packages(deps)
+    if missing:
+        _log_warn("Host dependency overlay is missing packages: %s" %
+                  ", ".join(missing))
+        return False
+    _log_info("Restored host dependencies in %.1fs" % (time() - start))
+    return True
+
+
+def save_host_overlay(overlay_dir, version, deps, baseline):
+    """Save the files of the host packages installed since the set of
+    packages ``baseline`` was taken, together with the rpm database,
+    account files and alternatives, as the host dependency overlay for
+    Fedora ``version`` and the package list ``deps`` in ``overlay_dir``.
+    """
+    new_pkgs = sorted(get_host_packages() - baseline)
+    if not new_pkgs:
+        return
+    overlay_path = host_overlay_path(overlay_dir, version, deps, baseline)
+    _log_info("Saving %d host packages to overlay %s" %
+              (len(new_pkgs), overlay_path))
+    start = time()
+    rpm_run = run(["rpm", "-ql"] + new_pkgs, capture_output=True)
+    paths = [path for path in rpm_run.stdout.decode('utf8').splitlines()
+             if path.startswith("/")]
+    makedirs(overlay_dir, exist_ok=True)
+    with tarfile.open(overlay_path + ".tmp", "w:gz",
+                      compresslevel=OVERLAY_COMPRESS_LEVEL) as overlay:
+        for path in paths:
+            if lexists(path) and path not in host_overlay_files:
+                overlay.add(path, recursive=False)
+        for path in host_overlay_files:
+            if exists(path):
+                overlay.add(path, arcname="accounts" + path)
+        for path in host_overlay_dirs:
+            if exists(path):
+                overlay.add(path)
+        if exists("/var/lib/rpm"):
+            overlay.add(realpath("/var/lib/rpm"))
+    rename(overlay_path + ".tmp", overlay_path)
+    _log_info("Saved host dependency overlay (%dMiB) in %.1fs" %
+              (stat(overlay_path).st_size // 2**20, time() - start))
+
+
+def chroot_path(root, path):
+    """Return the path at which the host ``path`` is visible in the chroot
+    at ``root``. Paths outside ``root`` are assumed to be reachable via the
+    chroot bind mounts.
+    """
+    if path.startswith(join(root, "")):
+        return join("/", relpath(path, root))
+    return path
+
+
+def _prefetch_worker(repo_url, groups, stage_dir, root, version):
+    """Download the packages for each (DEPTYPE, DEPS) tuple in ``groups``
+    and their dependencies from ``repo_url`` into ``stage_dir``/DEPTYPE.
+    Dependencies are resolved against the Fedora ``version`` installroot
+    at ``root`` so that only packages missing from the new root are
+    downloaded.
+    """
+    for (deptype, deps) in groups:
+        dest_dir = join(stage_dir, deptype)
+        makedirs(dest_dir, exist_ok=True)
+        # dnf places the cachedir inside the installroot
+        dl_cmd = ["dnf", "-y", "-q", "download", "--resolve",
+                  "--installroot", root, "--releasever", version,
+                  "--destdir", dest_dir,
+                  "--setopt=cachedir=/%s" % prefetch_cache_dir,
+                  "--repofrompath", "stratify-prefetch,%s" % repo_url,
+                  "--repo", "stratify-prefetch"]
+        dl_cmd.extend(deps)
+        start = time()
+        dl_run = run(dl_cmd, capture_output=True)
+        if dl_run.returncode != 0:
+            _log_warn("Failed to prefetch %s dependencies: %s" %
+                      (deptype, dl_run.stderr.decode('utf8').strip()))
+            continue
+        rpms = [join(dest_dir, f) for f in listdir(dest_dir)
+                if f.endswith(".rpm")]
+        _log_debug("Prefetched %d %s packages in %.1fs" %
+                   (len(rpms), deptype, time() - start))
+        _prefetch_rpms[deptype] = rpms
+
+
+def start_prefetch(repo_url, groups, stage_dir, root, version):
+    """Start downloading the chroot package dependencies in ``groups`` from
+    ``repo_url`` into ``stage_dir`` in the background, resolving them
+    against the Fedora ``version`` installroot at ``root``. The staging
+    directories are removed by ``remove_prefetch()``, which also runs at
+    exit.
+    """
+    global _prefetch_thread
+    _log_info("Prefetching %s dependencies in the background" %
+              ", ".join(deptype for (deptype, deps) in groups))
+    _prefetch_dirs.extend([stage_dir, join(root, prefetch_cache_dir)])
+    atexit_register(remove_prefetch)
+    _prefetch_thread = Thread(target=_prefetch_worker,
+                              args=(repo_url, groups, stage_dir, root,
+                                    version),
+                              daemon=True)
+    _prefetch_thread.start()
+
+
+def remove_prefetch():
+    """Remove the package prefetch staging directories.
+    """
+    while _prefetch_dirs:
+        shutil.rmtree(_prefetch_dirs.pop(), ignore_errors=True)
+
+
+def wait_prefetch():
+    """Wait for the background package prefetch to complete.
+    """
+    global _prefetch_thread
+    if _prefetch_thread is None:
+        return
+    if _prefetch_thread.is_alive():
+        _log_info("Waiting for package prefetch to complete")
+    _prefetch_thread.join()
+    _prefetch_thread = None
+
+
+def install_prefetched(deptype, chroot):
+    """Install the packages prefetched for ``deptype`` in ``chroot`` as a
+    local-only transaction. Return ``True`` on success, or ``False`` if
+    nothing was prefetched or the transaction failed.
+    """
+    wait_prefetch()
+    rpms = _prefetch_rpms.pop(deptype, None)
+    if not rpms:
+        return False
+    _log_info("Installing %d prefetched packages" % len(rpms))
+    pkg_cmd = ["dnf", "-y", "install", "--disablerepo=*"]
+    pkg_cmd.extend([chroot_path(chroot, rpm) for rpm in rpms])
+    pkg_run = runat(pkg_cmd, chroot, "/")
+    if pkg_run.returncode != 0:
+        _log_warn("Failed to install prefetched %s packages: falling back "
+                  "to repository install" % deptype)
+        return False
+    return True
+
+
+def _unescape_mountinfo(field):
+    """Decode the octal escapes used for white space and backslash
+    characters in /proc/self/mountinfo fields.
+    """
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), field)
+
+
+def get_mountinfo(refresh=False):
+    """Return the mount table as a list of (MOUNT_POINT, DEVNO) tuples in
+    mount order. The table is read from /proc/self/mountinfo once and then
+    kept up to date by ``mount()`` and ``umount()`` unless ``refresh`` is
+    ``True``. Callers that must see mounts made by other processes (for
+    example anaconda or commands run in the chroot) pass ``refresh``.
+    """
+    global _mountinfo
+    if _mountinfo is not None and not refresh:
+        return _mountinfo
+    _mountinfo = []
+    with open("/proc/self/mountinfo", "r", encoding="utf8") as mountinfo:
+        for line in mountinfo.read().splitlines():
+            fields = line.split()
+            (major, minor) = fields[2].split(":")
+            _mountinfo.append((_unescape_mountinfo(fields[4]),
+                               makedev(int(major), int(minor))))
+    return _mountinfo
+
+
+def is_mounted(where):
+    """Return ``True`` if a file system is mounted at ``where``, or
+    ``False`` otherwise.
+    """
+    where = realpath(where)
+    return any(mnt == where for (mnt, devno) in get_mountinfo())
+
+
+def _mount_syscall(what, where, fstype, flags):
+    """Mount ``what`` onto ``where`` using the mount(2) system call.
+    """
+    _log_debug("Calling mount(2): %s on %s (fstype=%s, flags=%#x)" %
+               (what, where, fstype, flags))
+    fstype = fstype.encode('utf8') if fstype else None
+    if _libc.mount(what.encode('utf8'), where.encode('utf8'),
+                   fstype, flags, None) != 0:
+        err = get_errno()
+        _log_error("Failed to mount '%s' on '%s': %s" %
+                   (what, where, strerror(err)))
+        fail(1)
+
+
 def mount(what, where, options=None, bind=False, fstype=None):
     """Mount ``what`` onto ``where``, optionally passing ``options`` to
     the mount program, and creating a bind mount if ``bind`` is ``True``.
+    Bind mounts and mounts with a known ``fstype`` use the mount(2) system
+    call directly. Mount points where ``what`` is already mounted are
+    skipped: a different block device or bind source mounted at ``where``
+    is an error.
     """
-    mount_cmd = ["mount"]
-    if bind:
-        mount_cmd.extend(["--bind"])
-    if fstype:
-        mount_cmd.extend(["-t", fstype])
-    if options:
-        mount_cmd.extend(["-o", options])
-    mount_cmd.extend([what, where])
-    _log_debug("Invoking mount command: %s" % " ".join(mount_cmd))
-    mount_run = run(mount_cmd)
-    if mount_run.returncode != 0:
-        _log_error("Failed to mount '%s' on '%s'" % (what, where))
-        fail(1)
+    where = realpath(where)
+    if is_mounted(where):
+        mounted = [devno for (mnt, devno) in get_mountinfo() if mnt == where]
+        expected = None
+        if exists(what):
+            st = stat(what)
+            expected = st.st_rdev if S_ISBLK(st.st_mode) else st.st_dev
+        if expected is not None and mounted[-1] != expected:
+            _log_error("Cannot mount '%s' on '%s': another file system is "
+                       "already mounted there" % (what, where))
+            fail(1)
+        _log_debug("Skipping mount of '%s': '%s' is already mounted" %
+                   (what, where))
+        return
+    if (bind or fstype) and not options:
+        _mount_syscall(what, where, fstype, MS_BIND if bind else 0)
+    else:
+        mount_cmd = ["mount"]
+        if bind:
+            mount_cmd.extend(["--bind"])
+        if fstype:
+            mount_cmd.extend(["-t", fstype])
+        if options:
+            mount_cmd.extend(["-o", options])
+        mount_cmd.extend([what, where])
+        _log_debug("Invoking mount command: %s" % " ".join(mount_cmd))
+        mount_run = run(mount_cmd)
+        if mount_run.returncode != 0:
+            _log_error("Failed to mount '%s' on '%s'" % (what, where))
+            fail(1)
+    get_mountinfo().append((where, stat(where).st_dev))
 
 
 def umount(where, check=True):
     """Unmount a device or file system mount point. If ``check`` is not
-    ``True`` ignore errors returned by the mount program.
+    ``True`` ignore errors returned by the umount2(2) system call. If
+    ``where`` is a block device all of its mount points are unmounted.
+    Paths that are not mounted are skipped.
     """
-    umount_cmd = ["umount", where]
-    _log_debug("Invoking umount command: %s" % " ".join(umount_cmd))
-    umount_run = run(umount_cmd)
-    if check and umount_run.returncode != 0:
-        _log_error("Failed to umount '%s'" % where)
-        fail(1)
+    mounts = get_mountinfo()
+    if exists(where) and S_ISBLK(stat(where).st_mode):
+        rdev = stat(where).st_rdev
+        targets = [mnt for (mnt, devno) in reversed(mounts) if devno == rdev]
+    else:
+        targets = [realpath(where)] if is_mounted(where) else []
+    if not targets:
+        _log_debug("Skipping umount of '%s': not mounted" % where)
+    for target in targets:
+        _log_debug("Calling umount2(2): %s" % target)
+        if _libc.umount2(target.encode('utf8'), 0) != 0:
+            err = get_errno()
+            if check:
+                _log_error("Failed to umount '%s': %s" %
+                           (target, strerror(err)))
+                fail(1)
+            _log_debug("Ignoring umount error for '%s': %s" %
+                       (target, strerror(err)))
+            continue
+        with _mountinfo_lock:
+            for idx in range(len(mounts) - 1, -1, -1):
+                if mounts[idx][0] == target:
+                    del mounts[idx]
+                    break
+
+
+def umount_tree(root, check=True):
+    """Unmount ``root`` and every file system mounted beneath it, in the
+    reverse of the order in which they were mounted. The mount table is
+    re-read to include mounts made by other processes.
+    """
+    prefix = join(realpath(root), "")
+    targets = [mnt for (mnt, devno) in reversed(get_mountinfo(refresh=True))
+               if mnt == prefix[:-1] or mnt.startswith(prefix)]
+    for target in targets:
+        _log_info("Unmounting %s" % target)
+        umount(target, check=check)
 
 
-def wipe_device(name):
-    """Overwrite disk label (MBR or GPT) on device ``name``.
+def wipe_devices(names):
+    """Overwrite disk labels (MBR or GPT) and file system signatures on
+    the list of devices ``names`` with a single wipefs call.
     """
-    wipefs_cmd = ["wipefs", "-a", "/dev/%s" % name]
+    wipefs_cmd = ["wipefs", "-a"]
+    wipefs_cmd.extend(["/dev/%s" % name for name in names])
     wipefs_run = run(wipefs_cmd)
     if wipefs_run.returncode != 0:
-        _log_error("Failed to wipe disk labels from '%s'" % name)
+        _log_error("Failed to wipe disk labels from '%s'" % ", ".join(names))
+
+
+def clear_signatures(name):
+    """Zero the regions at the start and end of device ``name`` that hold
+    partition tables and file system, Stratis, LVM, LUKS and MD
+    signatures.
+    """
+    fd = os_open("/dev/%s" % name, O_WRONLY)
+    try:
+        size = lseek(fd, 0, SEEK_END)
+        region = min(WIPE_REGION_SIZE, size)
+        zeros = bytes(region)
+        for offset in sorted({0, size - region}):
+            pwrite(fd, zeros, offset)
+        fdatasync(fd)
+    finally:
+        close(fd)
+
+
+def discard_device(name):
+    """Discard all blocks on device ``name`` using BLKDISCARD. Returns
+    ``True`` on success or ``False`` if the device does not support
+    discard or the request failed.
+    """
+    if not get_queue_limits(name)["discard_max_bytes"]:
+        return False
+    fd = os_open("/dev/%s" % name, O_WRONLY)
+    try:
+        size = lseek(fd, 0, SEEK_END)
+        ioctl(fd, BLKDISCARD, pack("QQ", 0, size))
+    except OSError as err:
+        _log_warn("Failed to discard device %s: %s" % (name, err))
+        return False
+    finally:
+        close(fd)
+    return True
 
 
 def mk_parttable(name):
@@ -373,10 +1287,59 @@ def mk_partitions(name, sizes):
             break
 
 
-def mkfs_xfs(device):
-    """Create an XFS file system on ``device`` with the default options.
+def get_queue_limits(device):
+    """Return a dictionary of the block queue limits in ``queue_limits``
+    for ``device``, which may be a device name or a path to a device node.
+    Partitions report the limits of the disk that contains them. Limits
+    that cannot be read are set to zero, except ``rotational`` which
+    defaults to one.
+    """
+    path = device if isabs(device) else "/dev/%s" % device
+    sys_path = join("/sys/class/block", basename(realpath(path)))
+    if exists(join(sys_path, "partition")):
+        sys_path = join(sys_path, "..")
+    limits = {}
+    for limit in queue_limits:
+        try:
+            with open(join(sys_path, "queue", limit), "r") as f:
+                limits[limit] = int(f.read().strip())
+        except (OSError, ValueError):
+            limits[limit] = 1 if limit == "rotational" else 0
+    _log_debug("Queue limits for %s: %s" % (device, limits))
+    return limits
+
+
+def xfs_mkfs_options(limits):
+    """Return a list of mkfs.xfs options matching the queue ``limits``: a
+    stripe unit and width are set when the device reports an optimal I/O
+    size that is a multiple of its minimum I/O size.
+    """
+    min_io = limits["minimum_io_size"]
+    opt_io = limits["optimal_io_size"]
+    if (min_io and not min_io % 4096 and
+            opt_io > min_io and not opt_io % min_io):
+        return ["-d", "su=%d,sw=%d" % (min_io, opt_io // min_io)]
+    return []
+
+
+def fs_mount_options(limits):
+    """Return the fstab mount option string for a file system on a device
+    with the queue ``limits``: non-rotational devices use ``noatime``.
+    Online discard is not used: unused blocks are trimmed periodically by
+    the fstrim.timer unit enabled by default in Fedora.
+    """
+    options = ["defaults"]
+    if not limits["rotational"]:
+        options.append("noatime")
+    return ",".join(options)
+
+
+def mkfs_xfs(device, options=None):
+    """Create an XFS file system on ``device`` with the default options or
+    the list of mkfs.xfs ``options`` if given.
     """
-    mkfs_cmd = ["mkfs.xfs", "/dev/%s" % device]
+    mkfs_cmd = ["mkfs.xfs"] + (options or []) + ["/dev/%s" % device]
+    _log_debug("Creating XFS file system: %s" % " ".join(mkfs_cmd))
     mkfs_run = run(mkfs_cmd)
     if mkfs_run.returncode != 0:
         _log_error("Failed to create XFS file system on '%s'" % device)
@@ -391,6 +1354,58 @@ def mkfs_vfat(device):
         _log_error("Failed to create VFAT file system on '%s'" % device)
 
 
+def _fs_workload(path):
+    """Write and sync ``BENCH_FILES`` small files below ``path`` and read
+    them back using direct I/O so that reads are not served from the page
+    cache. Returns the elapsed time in seconds.
+    """
+    data = urandom(BENCH_FILE_SIZE)
+    # Anonymous mappings are page aligned as required for O_DIRECT
+    buf = mmap(-1, BENCH_FILE_SIZE)
+    start = time()
+    for i in range(BENCH_FILES):
+        with open(join(path, "f%d" % i), "wb") as f:
+            f.write(data)
+    sync()
+    for i in range(BENCH_FILES):
+        fd = os_open(join(path, "f%d" % i), O_RDONLY | O_DIRECT)
+        try:
+            preadv(fd, [buf], 0)
+        finally:
+            close(fd)
+    return time() - start
+
+
+def tuning_benchmark(target):
+    """Compare default and tuned XFS file systems on loop devices using the
+    mkfs and mount options chosen for the queue limits of ``target``.
+    """
+    limits = get_queue_limits(target)
+    variants = [("default", [], "defaults"),
+                ("tuned", xfs_mkfs_options(limits), fs_mount_options(limits))]
+    bench_dir = mkdtemp(prefix="stratify-bench-", dir="/var/tmp")
+    try:
+        for (name, mkfs_opts, mount_opts) in variants:
+            image = join(bench_dir, "%s.img" % name)
+            mnt = join(bench_dir, name)
+            with open(image, "wb") as f:
+                f.truncate(BENCH_FS_SIZE * 2**20)
+            mkdir(mnt)
+            loop_dev = losetup_attach(image)
+            try:
+                mkfs_xfs(loop_dev, ["-q"] + mkfs_opts)
+                mount("/dev/%s" % loop_dev, mnt, options=mount_opts)
+                elapsed = _fs_workload(mnt)
+                umount(mnt)
+            finally:
+                losetup_detach(loop_dev)
+            _log_info("%s: mkfs options '%s', mount options '%s': %d files "
+                      "in %.2fs" % (name, " ".join(mkfs_opts), mount_opts,
+                                    BENCH_FILES, elapsed))
+    finally:
+        shutil.rmtree(bench_dir, ignore_errors=True)
+
+
 def create_pool(name, devices, encrypt=False):
     """Create a stratis pool named ``name`` on the list of devices
     given in ``devices``.
@@ -409,6 +1424,19 @@ def create_pool(name, devices, encrypt=False):
         fail(1)
 
 
+def create_cache(name, devices):
+    """Initialise a cache tier for the stratis pool ``name`` on the list of
+    devices given in ``devices``.
+    """
+    cache_cmd = ["stratis", "pool", "init-cache", name]
+    cache_cmd.extend(["/dev/%s" % d for d in devices])
+    cache_run = run(cache_cmd)
+    if cache_run.returncode != 0:
+        _log_error("Failed to initialise cache for pool '%s' on %s" %
+                   (name, ",".join(devices)))
+        fail(1)
+
+
 def create_fs(pool, name):
     """Create a stratis file system named ``name`` in ``pool``.
     """
@@ -468,42 +1496,98 @@ def stratisd_running():
     return False
 
 
-def destroy_pools():
-    """Attempt to destroy all stratis file systems and pools.
+def list_stratis_objects():
+    """Return a dictionary mapping the name of each stratis pool to the
+    list of its file system names (including snapshots). The objects are
+    read from ``stratis report`` with a fallback to parsing the output of
+    the ``stratis fs list`` and ``stratis pool list`` commands.
     """
-    if not stratisd_running():
-        start_stratisd()
+    report_run = run(["stratis", "report"], capture_output=True)
+    try:
+        report = json.loads(report_run.stdout)
+        return {pool["name"]: [fs["name"] for fs in pool["filesystems"]]
+                for pool in report["pools"]}
+    except (ValueError, KeyError, TypeError):
+        _log_debug("Could not parse stratis report: using list commands")
+
+    pools = {}
+    list_cmd = ["stratis", "pool", "list"]
+    list_out = run(list_cmd, capture_output=True).stdout.decode('utf8')
+    for line in list_out.splitlines():
+        if line.startswith("Name"):
+            continue
+        (name, rest) = line.split(maxsplit=1)
+        pools[name] = []
 
-    # First destroy each file system
-    fs_cmd = ["stratis", "fs"]
-    fs_list_cmd = fs_cmd + ["list"]
+    fs_list_cmd = ["stratis", "fs", "list"]
     fs_list_out = run(fs_list_cmd, capture_output=True).stdout.decode('utf8')
     for line in fs_list_out.splitlines():
         if line.startswith("Pool"):
             continue
         (pool, name, rest) = line.split(maxsplit=2)
-        _log_warn("Destroying file system %s in pool %s" % (name, pool))
-        umount("/dev/stratis/%s/%s" % (pool, name), check=False)
-        fs_dest_cmd = fs_cmd + ["destroy", pool, name]
-        fs_dest_run = run(fs_dest_cmd)
-        if fs_dest_run.returncode != 0:
-            _log_error("Failed to destroy file system %s in pool %s" %
-                       (name, pool))
-            fail(1)
+        pools.setdefault(pool, []).append(name)
+    return pools
+
+
+def _destroy_stratis_object(kind, names):
+    """Destroy the stratis ``kind`` ("fs" or "pool") identified by the
+    list ``names`` and return a (NAME, SECONDS, ERROR) tuple where ERROR
+    is ``None`` on success.
+    """
+    name = "/".join(names)
+    _log_warn("Destroying %s %s" %
+              ("file system" if kind == "fs" else "pool", name))
+    start = time()
+    dest_run = run(["stratis", kind, "destroy"] + names, capture_output=True)
+    error = None
+    if dest_run.returncode != 0:
+        error = (dest_run.stderr.decode('utf8').strip() or
+                 "exit status %d" % dest_run.returncode)
+    return (name, time() - start, error)
+
+
+def _destroy_pool(pool, filesystems):
+    """Destroy the list of ``filesystems`` in ``pool`` concurrently and then
+    the pool itself. Returns a list of (NAME, SECONDS, ERROR) tuples.
+    """
+    results = parallel([(_destroy_stratis_object, ("fs", [pool, fs]))
+                        for fs in filesystems])
+    if any(error for (name, seconds, error) in results):
+        return results
+    return results + [_destroy_stratis_object("pool", [pool])]
 
-    pool_cmd = ["stratis", "pool"]
-    list_cmd = pool_cmd + ["list"]
-    list_out = run(list_cmd, capture_output=True).stdout.decode('utf8')
-    for line in list_out.splitlines():
-        if line.startswith("Name"):
-            continue
-        (name, rest) = line.split(maxsplit=1)
-        _log_warn("Destroying pool %s" % name)
-        dest_cmd = pool_cmd + ["destroy", name]
-        dest_run = run(dest_cmd)
-        if dest_run.returncode != 0:
-            _log_error("Failed to destroy pool %s" % name)
-            fail(1)
+
+def destroy_pools():
+    """Attempt to destroy all stratis file systems and pools. File systems
+    are unmounted in parallel and each pool and its file systems are then
+    destroyed concurrently. All errors are reported before failing.
+    """
+    if not stratisd_running():
+        start_stratisd()
+
+    start = time()
+    pools = list_stratis_objects()
+    if not pools:
+        return
+    fs_devs = ["/dev/stratis/%s/%s" % (pool, fs)
+               for (pool, filesystems) in pools.items() for fs in filesystems]
+    get_mountinfo(refresh=True)
+    parallel([(umount, (fs_dev, False)) for fs_dev in fs_devs])
+
+    results = []
+    for pool_results in parallel([(_destroy_pool, (pool, filesystems))
+                                  for (pool, filesystems) in pools.items()]):
+        results.extend(pool_results)
+    for (name, seconds, error) in results:
+        if error:
+            _log_error("Failed to destroy %s after %.1fs: %s" %
+                       (name, seconds, error))
+        else:
+            _log_debug("Destroyed %s in %.1fs" % (name, seconds))
+    if any(error for (name, seconds, error) in results):
+        fail(1)
+    _log_info("Destroyed %d pools and %d file systems in %.1fs" %
+              (len(pools), len(fs_devs), time() - start))
 
 
 def start_stratisd():
@@ -536,17 +1620,22 @@ def udevadm_settle():
 
 
 def wipe_partitions(target):
-    """Wipe all partitions and the whole disk device ``target``.
+    """Wipe all partitions and the whole disk device ``target``. Devices
+    that support discard are discarded first to release backing storage.
+    The signature regions of each partition and the disk are then cleared
+    in parallel, falling back to a single wipefs call.
     """
-    parts = get_partitions(target)
-    if parts:
-        _log_warn("Wiping partitions on device %s" % target)
-        for part in parts:
-            _log_warn("Wiping partition %s" % part)
-            wipe_device(part)
+    devices = get_partitions(target) + [target]
 
-    _log_warn("Wiping device %s" % target)
-    wipe_device(target)
+    if discard_device(target):
+        _log_warn("Discarded device %s" % target)
+
+    _log_warn("Wiping %s" % ", ".join(devices))
+    try:
+        parallel([(clear_signatures, (device,)) for device in devices])
+    except OSError as err:
+        _log_warn("Failed to clear signatures (%s): using wipefs" % err)
+        wipe_devices(devices)
 
 
 def create_partitions(target, efi=False):
@@ -565,13 +1654,42 @@ def create_partitions(target, efi=False):
     mk_partitions(target, part_sizes)
 
 
+def prepare_boot_device(target, efi, efi_dev, boot_dev, wipe=False):
+    """Optionally wipe, then partition the boot disk ``target`` and create
+    the /boot and (for EFI systems) /boot/efi file systems.
+    """
+    if wipe:
+        wipe_partitions(target)
+
+    create_partitions(target, efi=efi)
+
+    if efi:
+        mkfs_vfat(efi_dev)
+
+    mkfs_xfs(boot_dev, xfs_mkfs_options(get_queue_limits(target)))
+
+
+def prepare_data_device(target, wipe=False):
+    """Optionally wipe, then partition the additional pool disk ``target``
+    with a single partition spanning the device. Returns the partition
+    device name.
+    """
+    if wipe:
+        wipe_partitions(target)
+
+    _log_info("Creating partition table on %s" % target)
+    mk_parttable(target)
+    mk_partitions(target, [0])
+    return get_partition_device(target, 1)
+
+
 def mount_stratis_root(pool, fs, root):
     """Mount the stratis root file system ``pool`/``fs`` at ``root``.
     """
     if not exists(root):
         mkdir(root)
     _log_info("Mounting %s/%s on %s" % (pool, fs, root))
-    mount("/dev/stratis/%s/%s" % (pool, fs), root)
+    mount("/dev/stratis/%s/%s" % (pool, fs), root, fstype="xfs")
 
 
 def mount_boot(boot_dev, root):
@@ -584,7 +1702,7 @@ def mount_boot(boot_dev, root):
         pass
 
     _log_info("Mounting %s on %s" % (boot_dev, boot_path))
-    mount("/dev/%s" % boot_dev, boot_path)
+    mount("/dev/%s" % boot_dev, boot_path, fstype="xfs")
     chmod(boot_path, 0o555)
 
 
@@ -598,7 +1716,7 @@ def mount_boot_efi(efi_dev, root):
         pass
 
     _log_info("Mounting %s on %s" % (efi_dev, efi_path))
-    mount("/dev/%s" % efi_dev, efi_path)
+    mount("/dev/%s" % efi_dev, efi_path, fstype="vfat")
     chmod(efi_path, 0o700)
 
 
@@ -620,6 +1738,10 @@ def teardown_chroot(root, bind_mounts):
     """Unmount selinuxfs and remove bind mounts specified in ``bind_mounts``
     from the chroot environment at ``root``.
     """
+    stop_chroot_server(root)
+    # Commands run in the chroot may have added mounts
+    get_mountinfo(refresh=True)
+
     selinux_path = join(root, "sys/fs/selinux")
     _log_info("Unmounting selinuxfs at %s" % selinux_path)
     umount(selinux_path)
@@ -645,14 +1767,165 @@ def git_clone(into, url, branch):
     return git_dir
 
 
-def runat(cmd, root_dir, cwd="/", shell=False, capture_output=False):
-    """Change root to ``root_dir`` and run ``cmd`` in directory ``cwd``.
+def runat(cmd, root_dir, cwd="/", shell=False, capture_output=False,
+          direct=False, env=None):
+    """Change root to ``root_dir`` and run ``cmd`` in directory ``cwd``
+    with the environment ``env``, or the current environment if ``env``
+    is ``None``. Commands are sent to the chroot server for ``root_dir``
+    if one is running unless ``direct`` is ``True``.
     """
+    server = None if direct else _chroot_servers.get(root_dir)
+    if server:
+        cmd_run = _chroot_request(root_dir, server, cmd, cwd, shell,
+                                  capture_output, env)
+        if cmd_run:
+            return cmd_run
+
     def _chroot_fn():
         chroot(root_dir)
         chdir(cwd)
     return run(cmd, preexec_fn=_chroot_fn, shell=shell,
-               capture_output=capture_output)
+               capture_output=capture_output, env=env)
+
+
+def _chroot_serve(req, replies, lock):
+    """Chroot server thread: run the command in ``req`` and write a JSON
+    reply tagged with the request ID to ``replies`` while holding ``lock``.
+    """
+    try:
+        cmd_run = run(req["cmd"], cwd=req["cwd"], shell=req["shell"],
+                      env=req["env"], capture_output=req["capture"],
+                      stdin=DEVNULL)
+        reply = {"id": req["id"], "returncode": cmd_run.returncode}
+        if req["capture"]:
+            reply["stdout"] = b64encode(cmd_run.stdout).decode()
+            reply["stderr"] = b64encode(cmd_run.stderr).decode()
+    except OSError as err:
+        reply = {"id": req["id"], "errno": err.errno, "error": err.strerror}
+    with lock:
+        replies.write(json.dumps(reply) + "\n")
+        replies.flush()
+
+
+def chroot_server(root_dir, req_fd, resp_fd):
+    """Run commands for the parent stratify.py process: change root to
+    ``root_dir`` once and execute each JSON request read from ``req_fd``
+    in its own thread, writing a JSON reply with the request ID, return
+    code and any captured output (base64 encoded) to ``resp_fd``.
+    """
+    chroot(root_dir)
+    chdir("/")
+    lock = Lock()
+    threads = []
+    with open(req_fd, "r") as requests, open(resp_fd, "w") as replies:
+        for line in requests:
+            thread = Thread(target=_chroot_serve,
+                            args=(json.loads(line), replies, lock))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+
+def _chroot_reply_reader(server):
+    """Chroot client thread: read replies from ``server`` and hand each
+    one to the request waiting for its ID. Marks the server closed when
+    the reply pipe is closed or a reply cannot be decoded.
+    """
+    try:
+        for line in server["replies"]:
+            reply = json.loads(line)
+            with server["cond"]:
+                server["results"][reply["id"]] = reply
+                server["cond"].notify_all()
+    except (OSError, ValueError):
+        pass
+    finally:
+        with server["cond"]:
+            server["closed"] = True
+            server["cond"].notify_all()
+
+
+def start_chroot_server(root_dir):
+    """Start a chroot server process for ``root_dir``: subsequent calls
+    to ``runat()`` for ``root_dir`` are executed by the server instead of
+    forking and changing root for each command.
+    """
+    (req_read, req_write) = pipe()
+    (resp_read, resp_write) = pipe()
+    server_cmd = [executable, realpath(__file__), "--chroot-server",
+                  root_dir, str(req_read), str(resp_write)]
+    _log_debug("Starting chroot server for %s", root_dir)
+    proc = Popen(server_cmd, pass_fds=(req_read, resp_write), stdin=DEVNULL)
+    close(req_read)
+    close(resp_write)
+    server = {
+        "proc": proc,
+        "requests": open(req_write, "w"),
+        "replies": open(resp_read, "r"),
+        "cond": Condition(),
+        "results": {},
+        "next_id": 0,
+        "closed": False
+    }
+    server["reader"] = Thread(target=_chroot_reply_reader, args=(server,),
+                              daemon=True)
+    server["reader"].start()
+    _chroot_servers[root_dir] = server
+
+
+def stop_chroot_server(root_dir):
+    """Stop the chroot server for ``root_dir`` if one is running.
+    """
+    server = _chroot_servers.pop(root_dir, None)
+    if not server:
+        return
+    _log_debug("Stopping chroot server for %s", root_dir)
+    with server["cond"]:
+        try:
+            server["requests"].close()
+        except OSError:
+            pass
+    server["reader"].join()
+    server["replies"].close()
+    server["proc"].wait()
+
+
+def _chroot_request(root_dir, server, cmd, cwd, shell, capture_output,
+                    env=None):
+    """Send ``cmd`` to the chroot ``server`` for ``root_dir`` and return a
+    ``CompletedProcess`` for the result, or ``None`` if the server failed.
+    The server lock is only held while writing the request: concurrent
+    requests run in parallel and their replies are matched by ID.
+    """
+    cond = server["cond"]
+    reply = None
+    with cond:
+        if not server["closed"]:
+            req_id = server["next_id"]
+            server["next_id"] += 1
+            req = {"id": req_id, "cmd": cmd, "cwd": cwd, "shell": shell,
+                   "env": env or dict(environ), "capture": capture_output}
+            try:
+                server["requests"].write(json.dumps(req) + "\n")
+                server["requests"].flush()
+                cond.wait_for(lambda: req_id in server["results"] or
+                              server["closed"])
+                reply = server["results"].pop(req_id, None)
+            except (OSError, ValueError):
+                reply = None
+    if not reply:
+        _log_warn("Chroot server for %s failed: running commands directly" %
+                  root_dir)
+        _chroot_servers.pop(root_dir, None)
+        return None
+    if "errno" in reply:
+        raise OSError(reply["errno"], reply["error"])
+    stdout = stderr = None
+    if capture_output:
+        stdout = b64decode(reply["stdout"])
+        stderr = b64decode(reply["stderr"])
+    return CompletedProcess(cmd, reply["returncode"], stdout, stderr)
 
 
 def reponame(url):
@@ -661,61 +1934,388 @@ def reponame(url):
     return url.rsplit('/')[-1]
 
 
-def install_from_git(root):
-    """For each (GIT_URL, BRANCH, INSTALL COMMAND) tuple in ``git_deps``
-    clone the repository into ``root``/git/<repository> and execute the
-    install command in the chroot.
+def build_jobs():
+    """Return the number of parallel build jobs to use given the number
+    of CPUs and the available memory.
     """
-    git_basedir = join("/", "root", "git")
+    mem_jobs = get_meminfo()["MemAvailable"] // 1024 // BUILD_JOB_MEM
+    return max(1, min(cpu_count() or 1, mem_jobs))
+
 
-    if not exists(git_basedir):
-        _log_info("Creating git directory %s" % git_basedir)
-        mkdir(git_basedir)
+def build_environment(cache_dir):
+    """Return a dictionary of environment variables setting the build
+    parallelism and, if ``cache_dir`` is set, enabling the sccache and
+    ccache compiler caches in ``cache_dir``.
+    """
+    jobs = build_jobs()
+    env = {"MAKEFLAGS": "-j%d" % jobs, "CARGO_BUILD_JOBS": str(jobs)}
+    if not cache_dir:
+        return env
+    if shutil.which("sccache"):
+        env["RUSTC_WRAPPER"] = "sccache"
+        env["SCCACHE_DIR"] = join(cache_dir, "sccache")
+    if exists(ccache_libdir):
+        env["PATH"] = "%s:%s" % (ccache_libdir, environ.get("PATH", ""))
+        env["CCACHE_DIR"] = join(cache_dir, "ccache")
+    return env
+
+
+def build_cache_stats(build_env):
+    """Return a dictionary mapping the compiler caches enabled in the build
+    environment ``build_env`` to a (HITS, MISSES) tuple since the
+    statistics were last zeroed.
+    """
+    stats = {}
+    env = dict(environ, **build_env)
+    if "SCCACHE_DIR" in build_env:
+        stats_cmd = ["sccache", "--show-stats", "--stats-format", "json"]
+        stats_run = run(stats_cmd, capture_output=True, env=env)
+        try:
+            sccache = json.loads(stats_run.stdout)["stats"]
+            hits = sccache["cache_hits"]["counts"].values()
+            misses = sccache["cache_misses"]["counts"].values()
+            stats["sccache"] = (sum(hits), sum(misses))
+        except (ValueError, KeyError):
+            _log_debug("Could not parse sccache statistics")
+    if "CCACHE_DIR" in build_env:
+        stats_run = run(["ccache", "--print-stats"], capture_output=True,
+                        env=env)
+        counters = {}
+        for line in stats_run.stdout.decode("utf8").splitlines():
+            (name, _, value) = line.partition("\t")
+            if value.isdigit():
+                counters[name] = int(value)
+        stats["ccache"] = (counters.get("direct_cache_hit", 0) +
+                           counters.get("preprocessed_cache_hit", 0),
+                           counters.get("cache_miss", 0))
+    return stats
+
+
+def install_from_git(root, basedir=git_basedir, cache_dir=build_cache_dir):
+    """For each (GIT_URL, BRANCH, INSTALL COMMAND) tuple in ``git_deps``
+    clone the repository into ``basedir``/<repository> and execute the
+    install command in the chroot. Builds run with parallelism set from
+    the available CPUs and memory and use the compiler cache in
+    ``cache_dir``, unless ``cache_dir`` is empty. The build environment
+    is only passed to the build commands.
+    """
+    if not exists(basedir):
+        _log_info("Creating git directory %s" % basedir)
+        makedirs(basedir)
+
+    build_env = build_environment(cache_dir)
+    _log_info("Building with %s jobs%s" % (build_env["CARGO_BUILD_JOBS"],
+              " and compiler cache %s" % cache_dir if cache_dir else ""))
+    env = dict(environ, **build_env)
+    if "SCCACHE_DIR" in build_env:
+        makedirs(build_env["SCCACHE_DIR"], exist_ok=True)
+        run(["sccache", "--stop-server"], stdout=DEVNULL, stderr=DEVNULL,
+            env=env)
+        run(["sccache", "--zero-stats"], stdout=DEVNULL, env=env)
+    if "CCACHE_DIR" in build_env:
+        makedirs(build_env["CCACHE_DIR"], exist_ok=True)
+        run(["ccache", "--zero-stats"], stdout=DEVNULL, env=env)
+    start = time()
 
     for git_dep in git_deps:
-        git_dir = join(git_basedir, reponame(git_dep[0]))
+        git_dir = join(basedir, reponame(git_dep[0]))
         if exists(git_dir):
             _log_info("Re-using existing git repository at %s", git_dir)
         else:
             _log_info("Cloning git repository %s into %s" %
-                      (git_dep[0], git_basedir))
-            git_dir = git_clone(git_basedir, git_dep[0], git_dep[1])
+                      (git_dep[0], basedir))
+            git_dir = git_clone(basedir, git_dep[0], git_dep[1])
 
         _log_info("Installing from %s (%s)" % (git_dep[1], git_dep[2]))
+        dep_env = dict(env)
         for build_cmd in git_dep[2]:
             build_cmd = build_cmd.split()
             if root != "/":
                 if git_dep[3][0].isupper():
                     envstr = git_dep[3] % root
                     envvar, envval = envstr.split("=")
-                    environ[envvar] = envval
+                    dep_env[envvar] = envval
                 else:
                     build_cmd.append(git_dep[3] % root)
             _log_info("Running build command: %s", " ".join(build_cmd))
-            runat(build_cmd, "/", join(git_basedir, git_dir))
+            runat(build_cmd, "/", join(basedir, git_dir), env=dep_env)
 
+    _log_info("Git builds completed in %s" % format_duration(time() - start))
+    for (cache, (hits, misses)) in build_cache_stats(build_env).items():
+        rate = 100 * hits / (hits + misses) if hits + misses else 0
+        _log_info("Compiler cache %s: %d hits, %d misses (%.0f%% hit rate)" %
+                  (cache, hits, misses, rate))
+    if "SCCACHE_DIR" in build_env:
+        run(["sccache", "--stop-server"], stdout=DEVNULL, stderr=DEVNULL)
 
-def enable_service(root, unit):
-    """Enable the systemd service ``unit`` in the chroot layout specified
-    by ``root``. The given ``unit`` must be present in the systemd path
-    `/usr/lib/systemd/system`.
+
+def losetup_attach(path, direct_io=True, partscan=False):
+    """Attach the file at ``path`` to a free loop device, using direct I/O
+    if ``direct_io`` is ``True`` and scanning for partitions if
+    ``partscan`` is ``True``. Returns the loop device name.
     """
-    _log_info("Enabling unit=%s for sysinit.target.wants in %s" %
-              (unit, root))
-    etc_path = "/etc/systemd/system/sysinit.target.wants"
-    usr_path = "/usr/lib/systemd/system"
-    if not exists(join(root, usr_path[1:])):
-        _log_warn("systemd unit path %s not found in %s" % (usr_path, root))
-    if not exists(join(root, etc_path[1:])):
-        _log_error("systemd target directory %s not found in %s" %
-                   (etc_path, root))
+    losetup_cmd = ["losetup", "--find", "--show"]
+    if direct_io:
+        losetup_cmd.append("--direct-io=on")
+    if partscan:
+        losetup_cmd.append("--partscan")
+    losetup_cmd.append(path)
+    losetup_run = run(losetup_cmd, capture_output=True)
+    if losetup_run.returncode != 0:
+        _log_error("Failed to attach loop device for %s" % path)
         fail(1)
-    etc_path = join(etc_path, unit)
-    usr_path = join(usr_path, unit)
-    try:
-        symlink(usr_path, join(root, etc_path[1:]))
-    except FileExistsError:
-        pass
+    return basename(losetup_run.stdout.decode('utf8').strip())
+
+
+def losetup_detach(name):
+    """Detach the loop device ``name``.
+    """
+    losetup_run = run(["losetup", "--detach", "/dev/%s" % name])
+    if losetup_run.returncode != 0:
+        _log_error("Failed to detach loop device %s" % name)
+
+
+def losetup_find(path):
+    """Return the name of a loop device attached to the file at ``path``,
+    or ``None`` if the file is not attached.
+    """
+    losetup_cmd = ["losetup", "--noheadings", "--output", "name",
+                   "--associated", path]
+    losetup_run = run(losetup_cmd, capture_output=True)
+    names = losetup_run.stdout.decode('utf8').split()
+    return basename(names[0]) if names else None
+
+
+def parse_size(size):
+    """Parse a size string with an optional k, m, g or t (binary) suffix
+    into a number of bytes. Returns ``None`` if ``size`` is not valid.
+    """
+    match = re.match(r"^(\d+)([kmgt]?)$", size.strip().lower())
+    if not match:
+        return None
+    return int(match.group(1)) * 1024 ** " kmgt".index(match.group(2) or " ")
+
+
+def attach_image(path, size=None, overwrite=False):
+    """Attach the disk image at ``path`` to a loop device using direct I/O,
+    first creating it as a sparse file of ``size`` bytes if ``size`` is
+    given. An existing image is only replaced if ``overwrite`` is ``True``
+    and it is not attached to a loop device. Returns the loop device name.
+    """
+    if size and exists(path):
+        loop_dev = losetup_find(path)
+        if loop_dev:
+            _log_error("Disk image %s is attached to %s: use --cleanup to "
+                       "release it" % (path, loop_dev))
+            fail(1)
+        if not overwrite:
+            _log_error("Disk image %s already exists: use --wipe to "
+                       "overwrite it" % path)
+            fail(1)
+    if size:
+        _log_info("Creating %d byte sparse disk image %s" % (size, path))
+        with open(path, "wb") as image:
+            image.truncate(size)
+    elif not exists(path):
+        _log_error("Disk image not found: %s" % path)
+        fail(1)
+    loop_dev = None if size else losetup_find(path)
+    if not loop_dev:
+        loop_dev = losetup_attach(path, partscan=True)
+        udevadm_settle()
+    _log_info("Using %s for disk image %s" % (loop_dev, path))
+    return loop_dev
+
+
+def release_image(pool, loop_dev):
+    """Stop the stratis ``pool`` if stratisd is running and detach the disk
+    image loop device ``loop_dev``.
+    """
+    if stratisd_running():
+        _log_info("Stopping pool %s" % pool)
+        run(["stratis", "pool", "stop", "--name", pool])
+        udevadm_settle()
+    _log_info("Detaching %s" % loop_dev)
+    losetup_detach(loop_dev)
+
+
+def _data_chunks(fd, size, chunk_size):
+    """Return the set of indexes of the ``chunk_size`` byte chunks of the
+    file ``fd`` that contain data, using SEEK_DATA and SEEK_HOLE to skip
+    holes.
+    """
+    chunks = set()
+    offset = 0
+    while offset < size:
+        try:
+            start = lseek(fd, offset, SEEK_DATA)
+        except OSError as err:
+            if err.errno == ENXIO:
+                break
+            raise
+        offset = lseek(fd, start, SEEK_HOLE)
+        chunks.update(range(start // chunk_size,
+                            (offset - 1) // chunk_size + 1))
+    return chunks
+
+
+def export_image(path, dest):
+    """Write a gzip compressed copy of the sparse disk image at ``path`` to
+    ``dest``. Chunks containing data are compressed in parallel as separate
+    gzip members: holes are not read and are written as pre-compressed
+    zero members.
+    """
+    _log_info("Exporting disk image %s to %s" % (path, dest))
+    start = time()
+    fd = os_open(path, O_RDONLY)
+    zero_members = {}
+
+    def _compress(offset, length, data):
+        if not data:
+            return zero_members[length]
+        return gzip_compress(pread(fd, length, offset), mtime=0)
+
+    try:
+        size = lseek(fd, 0, SEEK_END)
+        chunks = _data_chunks(fd, size, EXPORT_CHUNK_SIZE)
+        workers = cpu_count() or 1
+        with open(dest, "wb") as out, \
+                ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = []
+            for (idx, offset) in enumerate(range(0, size, EXPORT_CHUNK_SIZE)):
+                length = min(EXPORT_CHUNK_SIZE, size - offset)
+                if idx not in chunks and length not in zero_members:
+                    zero_members[length] = gzip_compress(bytes(length),
+                                                         mtime=0)
+                pending.append(executor.submit(_compress, offset, length,
+                                               idx in chunks))
+                # Bound the number of chunks held in memory
+                if len(pending) >= 2 * workers:
+                    out.write(pending.pop(0).result())
+            for future in pending:
+                out.write(future.result())
+            out.flush()
+            fdatasync(out.fileno())
+    finally:
+        close(fd)
+    _log_info("Exported %dm of data from a %dm disk image in %.1fs" %
+              (len(chunks) * EXPORT_CHUNK_SIZE // 2**20, size // 2**20,
+               time() - start))
+
+
+def benchmark_reads(path, passes=BENCH_PASSES, count=BENCH_READS,
+                    block_size=BENCH_BLOCK_SIZE):
+    """Run ``passes`` passes of ``count`` random direct reads of
+    ``block_size`` bytes against the file or device at ``path``. Every
+    pass reads the same offsets so that later passes show the effect of
+    caching. Returns a list of (MIB_PER_SEC, IOPS) tuples, one for each
+    pass.
+    """
+    fd = os_open(path, O_RDONLY | O_DIRECT)
+    try:
+        blocks = lseek(fd, 0, SEEK_END) // block_size
+        rand = Random(0)
+        offsets = [rand.randrange(blocks) * block_size for i in range(count)]
+        # Anonymous mappings are page aligned as required for O_DIRECT
+        buf = mmap(-1, block_size)
+        results = []
+        for i in range(passes):
+            start = time()
+            for offset in offsets:
+                preadv(fd, [buf], offset)
+            elapsed = time() - start
+            results.append((count * block_size / 2**20 / elapsed,
+                            count / elapsed))
+        return results
+    finally:
+        close(fd)
+
+
+def _log_bench_results(label, results):
+    """Log the (MIB_PER_SEC, IOPS) ``results`` of a read benchmark.
+    """
+    for (idx, (mibps, iops)) in enumerate(results):
+        _log_info("%s pass %d: %.1f MiB/s, %.0f IOPS" %
+                  (label, idx + 1, mibps, iops))
+
+
+def cache_benchmark(pool, cache_devs):
+    """Measure the effect of the cache tier of ``pool``: run a read
+    benchmark against a file in a temporary file system in the pool,
+    initialise the cache tier on ``cache_devs`` and repeat the benchmark
+    against the same file. The temporary file system is destroyed
+    afterwards.
+    """
+    bench_fs = "stratify-bench"
+    create_fs(pool, bench_fs)
+    udevadm_settle()
+    bench_dir = mkdtemp(prefix="stratify-bench-", dir="/var/tmp")
+    bench_path = join(bench_dir, "bench.img")
+    try:
+        mount("/dev/stratis/%s/%s" % (pool, bench_fs), bench_dir)
+        _log_info("Creating %dm benchmark file %s" % (BENCH_SIZE, bench_path))
+        with open(bench_path, "wb") as bench:
+            for i in range(BENCH_SIZE):
+                bench.write(urandom(2**20))
+            bench.flush()
+            fdatasync(bench.fileno())
+        _log_info("Running uncached read benchmark on %s (%d x %d random %d "
+                  "byte reads)" % (bench_path, BENCH_PASSES, BENCH_READS,
+                                   BENCH_BLOCK_SIZE))
+        baseline = benchmark_reads(bench_path)
+        _log_bench_results("Uncached", baseline)
+
+        _log_info("Creating cache for pool %s with %s" %
+                  (pool, ", ".join(cache_devs)))
+        create_cache(pool, cache_devs)
+        _log_info("Running cached read benchmark on %s" % bench_path)
+        results = benchmark_reads(bench_path)
+        _log_bench_results("Cached", results)
+    finally:
+        umount(bench_dir, check=False)
+        shutil.rmtree(bench_dir, ignore_errors=True)
+        destroy_run = run(["stratis", "fs", "destroy", pool, bench_fs])
+        if destroy_run.returncode != 0:
+            _log_warn("Failed to destroy benchmark file system %s/%s" %
+                      (pool, bench_fs))
+    _log_info("Cached read rate after warm-up: %.1fx the uncached rate "
+              "(%.0f vs %.0f IOPS)" % (results[-1][1] / baseline[-1][1],
+                                       results[-1][1], baseline[-1][1]))
+
+
+def enable_service(root, unit):
+    """Enable the systemd service ``unit`` in the chroot layout specified
+    by ``root``. The given ``unit`` must be present in the systemd path
+    `/usr/lib/systemd/system`.
+    """
+    _log_info("Enabling unit=%s for sysinit.target.wants in %s" %
+              (unit, root))
+    etc_path = "/etc/systemd/system/sysinit.target.wants"
+    usr_path = "/usr/lib/systemd/system"
+    if not exists(join(root, usr_path[1:])):
+        _log_warn("systemd unit path %s not found in %s" % (usr_path, root))
+    if not exists(join(root, etc_path[1:])):
+        _log_error("systemd target directory %s not found in %s" %
+                   (etc_path, root))
+        fail(1)
+    etc_path = join(etc_path, unit)
+    usr_path = join(usr_path, unit)
+    try:
+        symlink(usr_path, join(root, etc_path[1:]))
+    except FileExistsError:
+        pass
+
+
+def render_fstab(model):
+    """Return the contents of the fstab for the boot ``model``. Mount
+    options are chosen from the queue limits of each device.
+    """
+    fstab = "%s / xfs %s 0 1\n" % (model["root_dev"], model["root_opts"])
+    fstab += "/dev/%s /boot xfs %s 0 2\n" % (model["boot_dev"],
+                                             model["boot_opts"])
+    if model.get("swap_dev"):
+        fstab += "/dev/%s none swap defaults 0 0\n" % model["swap_dev"]
+    return fstab
 
 
 def write_fstab(root, pool, fs, boot_dev, swap_dev=None):
@@ -723,24 +2323,13 @@ def write_fstab(root, pool, fs, boot_dev, swap_dev=None):
     using the stratis ``pool`` and ``fs``, ``boot_dev`` and optionally
     ``swap_dev``.
     """
-    root_entry = "/dev/stratis/%s/%s / xfs defaults 0 1" % (pool, fs)
-    boot_entry = "/dev/%s /boot xfs defaults 0 2" % boot_dev
-    if swap_dev:
-        swap_entry = "/dev/%s none swap defaults 0 0"
-    else:
-        swap_entry = ""
-    fstab_path = join(root, etc_fstab)
-    with open(fstab_path, "w") as fstab:
-        fstab.write(root_entry + "\n")
-        fstab.write(boot_entry + "\n")
-        if swap_entry:
-            fstab.write(swap_entry)
-        fstab.flush()
-        fdatasync(fstab.fileno())
+    model = mount_model(pool, fs, boot_dev)
+    model["swap_dev"] = swap_dev
+    write_files(root, {etc_fstab: render_fstab(model)})
 
 
-def mk_dracut_initramfs(root):
-    """Create a dracut initramfs for the kernel(s) installed in the chroot.
+def get_kernel_versions(root):
+    """Return a list of the kernel versions installed in the chroot.
     """
     rpm_cmd = ["rpm", "-q", "--queryformat", "%{VERSION}-%{RELEASE}.%{ARCH}\n",
                "kernel"]
@@ -748,15 +2337,139 @@ def mk_dracut_initramfs(root):
     if rpm_run.returncode != 0:
         _log_error("Failed to list kernel versions: %s" % rpm_run.stderr)
         fail(1)
-    for version in rpm_run.stdout.splitlines():
-        version = version.decode('utf8')
-        dracut_cmd = ["dracut", "--force", "--verbose",
-                      "/boot/initramfs-%s.img" % version, version]
+    return [v.decode('utf8') for v in rpm_run.stdout.splitlines()]
+
+
+def initramfs_cache_inputs(root):
+    """Return a string describing the inputs to dracut in the chroot at
+    ``root`` other than the kernel version: the versions of all installed
+    packages, since a ``--no-hostonly`` image includes modules and
+    binaries from many packages besides dracut and Stratis, and the
+    dracut and file system configuration. Returns ``None`` if the
+    Stratis dracut module is not installed from a package.
+    """
+    rpm_cmd = ["rpm", "-q"]
+    rpm_cmd.extend(initramfs_deps)
+    rpm_run = runat(rpm_cmd, root, "/", capture_output=True)
+    if rpm_run.returncode != 0:
+        return None
+    rpm_run = runat(["rpm", "-qa"], root, "/", capture_output=True)
+    if rpm_run.returncode != 0:
+        return None
+    inputs = ["\n".join(sorted(rpm_run.stdout.decode('utf8').split()))]
+    conf_paths = list(initramfs_conf)
+    for conf_dir in ("etc/dracut.conf.d", "usr/lib/dracut/dracut.conf.d"):
+        if exists(join(root, conf_dir)):
+            conf_paths.extend(join(conf_dir, conf) for conf
+                              in sorted(listdir(join(root, conf_dir))))
+    for conf_path in conf_paths:
+        if exists(join(root, conf_path)):
+            with open(join(root, conf_path), "r", encoding="utf8") as conf:
+                inputs.append("%s\n%s" % (conf_path, conf.read()))
+    return "\n".join(inputs)
+
+
+def file_sha256(path):
+    """Return the SHA-256 hex digest of the file at ``path``.
+    """
+    digest = sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(2**20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def copy_file(src, dest):
+    """Copy the file ``src`` to ``dest`` via a temporary file and rename so
+    that ``dest`` is never left partially written.
+    """
+    shutil.copyfile(src, dest + ".tmp")
+    rename(dest + ".tmp", dest)
+
+
+def get_cached_initramfs(cache_dir, key):
+    """Return the path of the cached initramfs for ``key`` in
+    ``cache_dir`` if it exists and matches its recorded checksum, or
+    ``None``. Corrupt entries are removed.
+    """
+    img_path = join(cache_dir, "%s.img" % key)
+    sum_path = join(cache_dir, "%s.sha256" % key)
+    if not exists(img_path) or not exists(sum_path):
+        return None
+    with open(sum_path, "r") as checksum:
+        expected = checksum.read().strip()
+    if file_sha256(img_path) != expected:
+        _log_warn("Removing corrupt cached initramfs %s" % img_path)
+        for path in (img_path, sum_path):
+            unlink(path)
+        return None
+    # Record the use for least recently used eviction
+    utime(img_path)
+    return img_path
+
+
+def store_initramfs(cache_dir, key, path, max_size):
+    """Store the initramfs at ``path`` in ``cache_dir`` as ``key`` and
+    evict the least recently used images until the cache is no larger
+    than ``max_size`` MiB.
+    """
+    makedirs(cache_dir, exist_ok=True)
+    img_path = join(cache_dir, "%s.img" % key)
+    copy_file(path, img_path)
+    with open(join(cache_dir, "%s.sha256" % key), "w") as checksum:
+        checksum.write(file_sha256(img_path) + "\n")
+    images = sorted((stat(join(cache_dir, fname)).st_mtime, fname)
+                    for fname in listdir(cache_dir) if fname.endswith(".img"))
+    total = sum(stat(join(cache_dir, fname)).st_size
+                for (mtime, fname) in images)
+    for (mtime, fname) in images:
+        if total <= max_size * 2**20 or fname == basename(img_path):
+            continue
+        _log_info("Evicting cached initramfs %s" % fname)
+        total -= stat(join(cache_dir, fname)).st_size
+        unlink(join(cache_dir, fname))
+        unlink(join(cache_dir, fname[:-len(".img")] + ".sha256"))
+
+
+def mk_dracut_initramfs(root, versions=None, cache_dir=None,
+                        max_cache_size=INITRAMFS_CACHE_SIZE):
+    """Create a dracut initramfs for the kernel(s) installed in the chroot,
+    or for the kernel ``versions`` given. If ``cache_dir`` is set images
+    built from identical inputs are copied from the cache instead of
+    running dracut, and new images are added to the cache. Cached images
+    are built with ``--no-hostonly`` so that they do not depend on the
+    machine-id or the drivers for the host hardware, which are not part
+    of the cache key.
+    """
+    inputs = initramfs_cache_inputs(root) if cache_dir else None
+    if cache_dir and not inputs:
+        _log_info("Stratis dracut module not installed from a package: "
+                  "not using the initramfs cache")
+    for version in versions or get_kernel_versions(root):
+        img_path = join(root, "boot", "initramfs-%s.img" % version)
+        key = None
+        if inputs:
+            key = sha256(("%s\nno-hostonly\n%s" %
+                          (version, inputs)).encode("utf8"))
+            key = key.hexdigest()
+            cached = get_cached_initramfs(cache_dir, key)
+            if cached:
+                _log_info("Initramfs cache hit for %s (%s)" %
+                          (version, key[:12]))
+                copy_file(cached, img_path)
+                continue
+            _log_info("Initramfs cache miss for %s (%s)" % (version, key[:12]))
+        dracut_cmd = ["dracut", "--force", "--verbose"]
+        if key:
+            dracut_cmd.append("--no-hostonly")
+        dracut_cmd.extend(["/boot/initramfs-%s.img" % version, version])
         _log_info("Creating dracut initramfs")
         dracut_run = runat(dracut_cmd, root, "/")
         if dracut_run.returncode != 0:
             _log_error("Failed to generate initramfs")
             fail(1)
+        if key:
+            store_initramfs(cache_dir, key, img_path, max_cache_size)
 
 
 def install_bootloader(root, target):
@@ -771,8 +2484,8 @@ def install_bootloader(root, target):
         fail(1)
 
 
-def configure_bootloader(root):
-    """Configure the grub2 boot loader in the chroot.
+def configure_bootloader_mkconfig(root):
+    """Configure the grub2 boot loader in the chroot using grub2-mkconfig.
     """
     grub2_mkconfig_cmd = ["grub2-mkconfig > /boot/grub2/grub.cfg"]
 
@@ -796,35 +2509,6 @@ def get_fs_uuid(device):
     return lsblk_out.strip()
 
 
-def configure_bootloader_stub(root, boot_dev):
-    """Configure the EFI grub.cfg stub to redirect to the configuration
-    in /boot/grub2/grub.cfg.
-    """
-    grub_stub = (
-        "search --no-floppy --fs-uuid --set=dev %s\n"
-        "set prefix=($dev)/grub2\n"
-        "export $prefix\n"
-        "configfile $prefix/grub.cfg\n"
-    )
-    boot_uuid = get_fs_uuid(boot_dev)
-    stub_path = join(root, "boot/efi/EFI/fedora/grub.cfg")
-    _log_info("Generating grub.cfg EFI stub at %s" % stub_path)
-    with open(stub_path, "w") as stub:
-        stub.write(grub_stub % boot_uuid)
-        stub.flush()
-        fdatasync(stub.fileno())
-
-
-def unlink_bootentries(root):
-    """Clean up Anaconda generated boot entries.
-    """
-    bls_dir = "boot/loader/entries"
-    bls_path = join(root, bls_dir)
-    for fname in listdir(bls_path):
-        if fname.endswith(".conf"):
-            unlink(join(bls_path, fname))
-
-
 def get_stratis_pool_uuid(pool):
     """Return the stratis root fs pool uuid.
     """
@@ -856,23 +2540,357 @@ def configure_boom(root, pool_uuid):
         _log_error("Failed to create OsProfile")
 
 
-def create_boot_entry(root, root_dev, title=None):
-    """Create a boom boot entry for the stratis root fs.
+def create_boot_entry(root, root_dev, title=None, version=None):
+    """Create a boom boot entry for the stratis root fs, optionally for the
+    kernel ``version`` given.
     """
     _log_info("Creating boom boot entry")
     boom_cmd = ["boom", "create", "--root-device", root_dev]
     if title:
         boom_cmd.extend(["--title", title])
+    if version:
+        boom_cmd.extend(["--version", version])
     boom_run = runat(boom_cmd, root, "/")
 
 
-def configure_etc_kernel_cmdline(root, root_dev, pool_uuid):
-    """Configure /etc/kernel/cmdline to boot from Stratis root.
+def get_boot_entries(root):
+    """Return a dictionary mapping the kernel version of each BLS boot
+    entry in ``root``/boot to a list of (FILE_NAME, OPTIONS) tuples, where
+    OPTIONS is the list of kernel options of the entry.
+    """
+    bls_path = join(root, "boot/loader/entries")
+    entries = {}
+    for fname in listdir(bls_path):
+        if not fname.endswith(".conf"):
+            continue
+        with open(join(bls_path, fname), "r", encoding="utf8") as entry:
+            fields = dict(line.strip().partition(" ")[::2]
+                          for line in entry.read().splitlines())
+        if "version" in fields:
+            entries.setdefault(fields["version"].strip(), []).append(
+                (fname, fields.get("options", "").split()))
+    return entries
+
+
+def ensure_boom_profile(root, pool_uuid):
+    """Create the boom OsProfile for the stratis root fs in the chroot at
+    ``root`` unless a profile for ``pool_uuid`` already exists. Profiles
+    for another stratis pool UUID are removed first.
+    """
+    profiles_path = join(root, "boot/boom/profiles")
+    pool_opt = "stratis.rootfs.pool_uuid=%s" % pool_uuid
+    if exists(profiles_path):
+        for fname in listdir(profiles_path):
+            with open(join(profiles_path, fname), "r",
+                      encoding="utf8") as profile:
+                options = profile.read()
+            if pool_opt in options:
+                return
+            if "stratis.rootfs.pool_uuid=" in options:
+                _log_info("Removing boom OsProfile %s for another pool" %
+                          fname)
+                unlink(join(profiles_path, fname))
+    configure_boom(root, pool_uuid)
+
+
+def sync_boot_entries(root, model):
+    """Remove the BLS boot entries in the chroot at ``root`` for kernels
+    that are not installed or that do not boot the pool of the boot
+    ``model``, and create entries for installed kernels that have none.
+    Entries are rendered from ``model``, or created by running boom if the
+    system has no machine-id. Returns the dictionary of files written.
+    """
+    pool_opt = "stratis.rootfs.pool_uuid=%s" % model["pool_uuid"]
+    current = set()
+    for (version, found) in get_boot_entries(root).items():
+        for (fname, options) in found:
+            if version in model["kernels"] and pool_opt in options:
+                current.add(version)
+                continue
+            _log_info("Removing boot entry %s" % fname)
+            unlink(join(root, "boot/loader/entries", fname))
+    missing = [version for version in model["kernels"]
+               if version not in current]
+    files = {}
+    if missing and not model["machine_id"]:
+        _log_warn("No machine-id found in %s/etc/machine-id: creating boot "
+                  "entries with boom" % root)
+        ensure_boom_profile(root, model["pool_uuid"])
+        for version in missing:
+            create_boot_entry(root, model["root_dev"], version=version)
+        return files
+    for version in missing:
+        (path, entry) = render_bls_entry(model, version)
+        files[path] = entry
+    write_files(root, files)
+    return files
+
+
+def list_snapshots(pool, fs):
+    """Return the names of the pristine snapshots of ``pool``/``fs``,
+    oldest first.
+    """
+    prefix = "%s-pristine-" % fs
+    fs_list_cmd = ["stratis", "fs", "list", pool]
+    fs_list_out = run(fs_list_cmd, capture_output=True).stdout.decode('utf8')
+    snapshots = []
+    for line in fs_list_out.splitlines():
+        if line.startswith("Pool"):
+            continue
+        (fs_pool, name, rest) = line.split(maxsplit=2)
+        if fs_pool == pool and name.startswith(prefix):
+            snapshots.append(name)
+    return sorted(snapshots)
+
+
+def snapshot_fs(pool, fs, keep):
+    """Take a pristine snapshot of ``pool``/``fs`` and destroy the oldest
+    pristine snapshots so that at most ``keep`` remain.
+    """
+    name = "%s-pristine-%s" % (fs, strftime("%Y%m%d%H%M%S"))
+    _log_info("Creating snapshot %s of %s/%s" % (name, pool, fs))
+    sync()
+    snap_run = run(["stratis", "fs", "snapshot", pool, fs, name])
+    if snap_run.returncode != 0:
+        _log_error("Failed to snapshot %s/%s" % (pool, fs))
+        return
+    snapshots = list_snapshots(pool, fs)
+    for old in snapshots[:max(len(snapshots) - keep, 0)]:
+        _log_info("Destroying old snapshot %s/%s" % (pool, old))
+        dest_run = run(["stratis", "fs", "destroy", pool, old])
+        if dest_run.returncode != 0:
+            _log_warn("Failed to destroy snapshot %s/%s" % (pool, old))
+
+
+def reset_fs(pool, fs, snapshot=None):
+    """Replace ``pool``/``fs`` with a new snapshot of the pristine snapshot
+    named ``snapshot``, or of the most recent pristine snapshot if
+    ``snapshot`` is not given.
+    """
+    snapshots = list_snapshots(pool, fs)
+    if not snapshots:
+        _log_error("No pristine snapshots of %s/%s found" % (pool, fs))
+        fail(1)
+    snapshot = snapshot or snapshots[-1]
+    if snapshot not in snapshots:
+        _log_error("Snapshot %s not found in pool %s (available: %s)" %
+                   (snapshot, pool, ", ".join(snapshots)))
+        fail(1)
+    _log_info("Resetting %s/%s to snapshot %s" % (pool, fs, snapshot))
+    umount("/dev/stratis/%s/%s" % (pool, fs))
+    fs_dest_run = run(["stratis", "fs", "destroy", pool, fs])
+    if fs_dest_run.returncode != 0:
+        _log_error("Failed to destroy file system %s in pool %s" % (fs, pool))
+        fail(1)
+    snap_run = run(["stratis", "fs", "snapshot", pool, snapshot, fs])
+    if snap_run.returncode != 0:
+        _log_error("Failed to restore %s/%s from snapshot %s" %
+                   (pool, fs, snapshot))
+        fail(1)
+    udevadm_settle()
+
+
+def read_os_release(root):
+    """Return a dictionary of the os-release fields of the system at
+    ``root``.
+    """
+    fields = {}
+    for path in ("etc/os-release", "usr/lib/os-release"):
+        if not exists(join(root, path)):
+            continue
+        with open(join(root, path), "r", encoding="utf8") as os_release:
+            for line in os_release.read().splitlines():
+                (name, sep, value) = line.partition("=")
+                if sep and not name.startswith("#"):
+                    fields[name.strip()] = value.strip().strip("\"'")
+        break
+    return fields
+
+
+def mount_model(pool, fs, boot_dev):
+    """Return the mount configuration model for the stratis ``pool`` and
+    ``fs`` and the boot device ``boot_dev``.
+    """
+    root_dev = "/dev/stratis/%s/%s" % (pool, fs)
+    return {
+        "root_dev": root_dev,
+        "root_opts": fs_mount_options(get_queue_limits(root_dev)),
+        "boot_dev": boot_dev,
+        "boot_opts": fs_mount_options(get_queue_limits(boot_dev)),
+    }
+
+
+def boot_model(root, pool, fs, boot_dev, efi):
+    """Return the model from which the boot and mount configuration of the
+    system installed at ``root`` is rendered.
+    """
+    model = mount_model(pool, fs, boot_dev)
+    kernels = []
+    for version in get_kernel_versions(root):
+        if exists(join(root, "boot", "vmlinuz-%s" % version)):
+            kernels.append(version)
+        else:
+            _log_warn("Kernel image for %s is missing from /boot: reinstall "
+                      "the kernel package" % version)
+    machine_id = ""
+    if exists(join(root, "etc/machine-id")):
+        with open(join(root, "etc/machine-id"), "r") as machine_id_file:
+            machine_id = machine_id_file.read().strip()
+    pool_uuid = get_stratis_pool_uuid(pool)
+    model.update({
+        "efi": efi,
+        "boot_uuid": get_fs_uuid(boot_dev),
+        "pool_uuid": pool_uuid,
+        "kernels": kernels,
+        "os_release": read_os_release(root),
+        "machine_id": machine_id,
+    })
+    return model
+
+
+def render_cmdline(model):
+    """Return the kernel command line for the boot ``model``.
     """
-    with open(join(root, "etc/kernel/cmdline"), "w", encoding="utf8") as file:
-        file.write(
-            "root=%s ro stratis.rootfs.pool_uuid=%s\n" % (root_dev, pool_uuid)
-        )
+    return "root=%s ro stratis.rootfs.pool_uuid=%s" % (model["root_dev"],
+                                                        model["pool_uuid"])
+
+
+def render_boom_profile(model):
+    """Return a (PATH, CONTENTS, OS_ID) tuple for the boom OsProfile of
+    the boot ``model``, equivalent to ``boom profile create --from-host``
+    with stratis root options.
+    """
+    os_release = model["os_release"]
+    name = os_release.get("NAME", "Linux")
+    short_name = os_release.get("ID", "linux")
+    version = os_release.get("VERSION", "")
+    version_id = os_release.get("VERSION_ID", "")
+    os_id = sha1((short_name + version + version_id).encode("utf8"))
+    os_id = os_id.hexdigest()
+    options = ("root=%%{root_device} ro %%{root_opts} "
+               "stratis.rootfs.pool_uuid=%s" % model["pool_uuid"])
+    profile = [
+        ("BOOM_OS_ID", os_id),
+        ("BOOM_OS_NAME", name),
+        ("BOOM_OS_SHORT_NAME", short_name),
+        ("BOOM_OS_VERSION", version),
+        ("BOOM_OS_VERSION_ID", version_id),
+        ("BOOM_OS_KERNEL_PATTERN", "/vmlinuz-%{version}"),
+        ("BOOM_OS_INITRAMFS_PATTERN", "/initramfs-%{version}.img"),
+        ("BOOM_OS_ROOT_OPTS_LVM2", "rd.lvm.lv=%{lvm_root_lv}"),
+        ("BOOM_OS_ROOT_OPTS_BTRFS", "rootflags=%{btrfs_subvolume}"),
+        ("BOOM_OS_OPTIONS", options),
+        ("BOOM_OS_TITLE", "%{os_name} %{os_version} (%{version})"),
+    ]
+    if short_name == "fedora":
+        profile.append(("BOOM_OS_UNAME_PATTERN", "fc%s" % version_id))
+    path = "boot/boom/profiles/%s-%s%s.profile" % (os_id, short_name,
+                                                    version_id)
+    contents = "".join('%s="%s"\n' % field for field in profile)
+    return (path, contents, os_id)
+
+
+def render_bls_entry(model, version):
+    """Return a (PATH, CONTENTS) tuple for the BLS boot entry for kernel
+    ``version`` in the boot ``model``, following the format written by
+    boom. The model must include a machine-id.
+    """
+    os_release = model["os_release"]
+    os_id = render_boom_profile(model)[2]
+    entry = "\n".join([
+        "title %s %s (%s)" % (os_release.get("NAME", "Linux"),
+                              os_release.get("VERSION", ""), version),
+        "machine-id %s" % model["machine_id"],
+        "version %s" % version,
+        "linux /vmlinuz-%s" % version,
+        "initrd /initramfs-%s.img" % version,
+        "options %s" % render_cmdline(model),
+        "grub_users $grub_users",
+        "grub_arg --unrestricted",
+        "grub_class kernel",
+    ]) + "\n"
+    boot_id = sha1(entry.encode("utf8")).hexdigest()
+    path = "boot/loader/entries/%s-%s-%s.conf" % (model["machine_id"],
+                                                   boot_id[:7], version)
+    return (path, "#OsIdentifier: %s\n" % os_id + entry)
+
+
+def render_boot_config(model, grub=True, boom=True):
+    """Return a dictionary mapping paths relative to the system root to
+    the contents of the boot and mount configuration files rendered from
+    the boot ``model``: the fstab, /etc/kernel/cmdline, the EFI grub.cfg
+    stub and, if ``grub`` is ``True``, the BLS enabled grub.cfg. If
+    ``boom`` is ``True`` the boom OsProfile is included.
+    """
+    files = {
+        etc_fstab: render_fstab(model),
+        "etc/kernel/cmdline": render_cmdline(model) + "\n",
+    }
+    if model["efi"]:
+        files["boot/efi/EFI/fedora/grub.cfg"] = grub_stub % model["boot_uuid"]
+    if grub:
+        files["boot/grub2/grub.cfg"] = grub_cfg % {
+            "version": _version, "boot_uuid": model["boot_uuid"]
+        }
+    if boom:
+        (path, profile, os_id) = render_boom_profile(model)
+        files[path] = profile
+    return files
+
+
+def syncfs(path):
+    """Flush the file system containing ``path`` to stable storage.
+    """
+    fd = os_open(path, O_RDONLY)
+    try:
+        if _libc.syncfs(fd) != 0:
+            _log_error("Failed to sync file system at %s: %s" %
+                       (path, strerror(get_errno())))
+            fail(1)
+    finally:
+        close(fd)
+
+
+def write_files(root, files):
+    """Atomically write each file in the dictionary ``files`` mapping
+    paths relative to ``root`` to their contents, then make the data
+    durable with one ``syncfs()`` call for each file system written.
+    """
+    fs_dirs = {}
+    for (path, contents) in files.items():
+        file_path = join(root, path)
+        file_dir = dirname(file_path)
+        makedirs(file_dir, exist_ok=True)
+        with open(file_path + ".tmp", "w", encoding="utf8") as file:
+            file.write(contents)
+        rename(file_path + ".tmp", file_path)
+        fs_dirs.setdefault(stat(file_dir).st_dev, file_dir)
+    for fs_dir in fs_dirs.values():
+        syncfs(fs_dir)
+
+
+def configure_boot(root, model, mkconfig=False):
+    """Write the boot and mount configuration rendered from the boot
+    ``model`` to the system at ``root`` and bring the boot entries in
+    line with the installed kernels using ``sync_boot_entries()``. The
+    grub2 configuration is generated with grub2-mkconfig if ``mkconfig``
+    is ``True`` or if no installed kernel images are found in /boot. The
+    boom OsProfile is rendered unless the system has no machine-id, in
+    which case boom creates it. Returns the dictionary of files written.
+    """
+    if not model["kernels"] and not mkconfig:
+        _log_warn("No kernel images found in %s/boot: using grub2-mkconfig"
+                  % root)
+        mkconfig = True
+    files = render_boot_config(model, grub=not mkconfig,
+                               boom=bool(model["machine_id"]))
+    _log_info("Writing boot configuration for %s: %s" %
+              (", ".join(model["kernels"]), ", ".join(sorted(files))))
+    write_files(root, files)
+    files.update(sync_boot_entries(root, model))
+    if mkconfig:
+        configure_bootloader_mkconfig(root)
+    return files
 
 
 def restorecon(root, path, recursive=False):
@@ -892,18 +2910,142 @@ def restorecon(root, path, recursive=False):
         fail(1)
 
 
+def restorecon_paths(root, paths):
+    """Restore the SELinux contexts of the list of ``paths`` in the chroot
+    at ``root`` with a single ``restorecon`` call.
+    """
+    if not paths:
+        return
+    list_path = join(root, spill_dir, "restorecon.list")
+    makedirs(dirname(list_path), exist_ok=True)
+    with open(list_path, "w", encoding="utf8") as path_list:
+        path_list.write("".join(path + "\n" for path in paths))
+    restorecon_cmd = ["restorecon", "-f", chroot_path(root, list_path)]
+    restorecon_run = runat(restorecon_cmd, root)
+    unlink(list_path)
+    if restorecon_run.returncode != 0:
+        _log_error("Failed to restore SELinux contexts for %d paths in %s" %
+                   (len(paths), root))
+        fail(1)
+
+
+def get_package_versions(root):
+    """Return a dictionary mapping the NAME.ARCH of each package installed
+    in the chroot at ``root`` to the set of installed VERSION-RELEASE
+    strings.
+    """
+    rpm_cmd = ["rpm", "-qa", "--queryformat",
+               "%{NAME}.%{ARCH} %{VERSION}-%{RELEASE}\n"]
+    rpm_run = runat(rpm_cmd, root, "/", capture_output=True)
+    if rpm_run.returncode != 0:
+        _log_error("Failed to list installed packages in %s" % root)
+        fail(1)
+    versions = {}
+    for line in rpm_run.stdout.decode('utf8').splitlines():
+        (name, version) = line.split()
+        versions.setdefault(name, set()).add(version)
+    return versions
+
+
+def get_package_files(root, packages):
+    """Return the list of files owned by ``packages`` in the chroot at
+    ``root``.
+    """
+    rpm_cmd = ["rpm", "-ql"]
+    rpm_cmd.extend(packages)
+    rpm_run = runat(rpm_cmd, root, "/", capture_output=True)
+    return [path for path in rpm_run.stdout.decode('utf8').splitlines()
+            if path.startswith("/")]
+
+
+def get_cmdline_pool_uuid(root):
+    """Return the stratis pool UUID in /etc/kernel/cmdline in ``root``, or
+    ``None`` if it is not set.
+    """
+    try:
+        with open(join(root, "etc/kernel/cmdline"), "r") as cmdline:
+            for arg in cmdline.read().split():
+                if arg.startswith("stratis.rootfs.pool_uuid="):
+                    return arg.split("=", maxsplit=1)[1]
+    except OSError:
+        pass
+    return None
+
+
+def update_system(root, pool, fs, boot_dev, efi, target, mkconfig=False,
+                  initramfs_cache=None):
+    """Upgrade the Stratis, kernel and boot packages in the chroot at
+    ``root`` and regenerate the initramfs, boot loader configuration and
+    boot entries only when the kernel, dracut, stratisd-dracut, boot
+    loader packages or the pool UUID changed. Existing boot entries are
+    kept for installed kernels that boot the pool and only stale or
+    missing entries are changed. SELinux contexts are restored for the
+    changed files only. Images are taken from the ``initramfs_cache``
+    directory if set.
+    """
+    begin_phase("upgrade")
+    before = get_package_versions(root)
+    old_pool_uuid = get_cmdline_pool_uuid(root)
+    boot_pkgs = boot_deps + (boot_deps_efi if efi else boot_deps_pc)
+    update_pkgs = (update_deps + package_deps + package_deps_stratis +
+                   boot_pkgs)
+    _log_info("Upgrading packages: %s" % ", ".join(update_pkgs))
+    dnf_cmd = ["dnf", "-y", "upgrade"]
+    dnf_cmd.extend(update_pkgs)
+    dnf_run = runat(dnf_cmd, root, "/")
+    if dnf_run.returncode != 0:
+        _log_error("Failed to upgrade packages")
+        fail(1)
+    after = get_package_versions(root)
+    changed = sorted(name for name in after if after[name] != before.get(name))
+    _log_info("%d packages changed%s" %
+              (len(changed), (": %s" % ", ".join(changed)) if changed else ""))
+
+    changed_names = {name.rsplit(".", maxsplit=1)[0] for name in changed}
+    model = boot_model(root, pool, fs, boot_dev, efi)
+    pool_changed = model["pool_uuid"] != old_pool_uuid
+    kernel_changed = any(name.startswith("kernel") for name in changed_names)
+    dracut_changed = bool({"dracut", "stratisd-dracut"} & changed_names)
+    grub_changed = bool(set(boot_pkgs) & changed_names)
+    if pool_changed:
+        _log_info("Pool UUID changed from %s to %s" %
+                  (old_pool_uuid, model["pool_uuid"]))
+
+    paths = get_package_files(root, changed) if changed else []
+    if kernel_changed or pool_changed or grub_changed:
+        begin_phase("bootloader")
+        if grub_changed and not efi:
+            install_bootloader(root, target)
+        files = configure_boot(root, model, mkconfig=mkconfig)
+        paths.extend("/" + path for path in files)
+
+    if dracut_changed or pool_changed:
+        begin_phase("dracut")
+        mk_dracut_initramfs(root, cache_dir=initramfs_cache)
+    elif kernel_changed:
+        begin_phase("dracut")
+        new_kernels = [version for version in model["kernels"]
+                       if not exists(join(root, "boot",
+                                          "initramfs-%s.img" % version))]
+        mk_dracut_initramfs(root, versions=new_kernels,
+                            cache_dir=initramfs_cache)
+    else:
+        _log_info("Kernel, dracut and pool unchanged: keeping initramfs")
+
+    paths = sorted({path for path in paths
+                    if path.startswith(("/etc/", "/usr/", "/var/")) and
+                    exists(join(root, path[1:]))})
+    if paths:
+        begin_phase("selinux")
+        _log_info("Restoring SELinux contexts for %d changed paths" %
+                  len(paths))
+        restorecon_paths(root, paths)
+
+
 def cleanup(root, efi, bind_mounts):
     _log_info("Unmounting %s %s chroot layout" % ("EFI" if efi else "BIOS", root))
     teardown_chroot(root, bind_mounts)
-    boot = join(root, "boot")
-    if efi:
-        boot_efi = join(boot, "efi")
-        _log_info("Unmounting %s from %s" % (boot_efi, root))
-        umount(boot_efi)
-    _log_info("Unmounting %s from %s" % (boot, root))
-    umount(boot)
-    _log_info("Unmounting %s" % root)
-    umount(root)
+    umount_tree(root)
 
 
 def is_bios():
@@ -920,6 +3062,76 @@ def get_fedora_version():
                 return line.split("=")[1]
 
 
+def probe_mirror(url):
+    """Fetch repodata/repomd.xml from the repository at ``url`` and return
+    a dictionary with the request latency (seconds to the first byte),
+    throughput (bytes per second) and repository metadata revision, or
+    ``None`` if the repository could not be reached.
+    """
+    repomd_url = url.rstrip("/") + "/repodata/repomd.xml"
+    start = time()
+    try:
+        with urlopen(repomd_url, timeout=MIRROR_TIMEOUT) as repomd:
+            data = repomd.read(1)
+            latency = time() - start
+            data += repomd.read()
+    except (OSError, ValueError) as err:
+        _log_debug("Mirror %s failed: %s" % (url, err))
+        return None
+    elapsed = max(time() - start, 1e-6)
+    match = re.search(rb"<revision>([^<]*)</revision>", data)
+    return {
+        "url": url,
+        "latency": latency,
+        "throughput": len(data) / elapsed,
+        "elapsed": elapsed,
+        "revision": match.group(1).decode("utf8") if match else None,
+    }
+
+
+def select_mirror(mirrors, ttl=MIRROR_CACHE_TTL):
+    """Probe the repository URLs in ``mirrors`` concurrently and return the
+    fastest one that serves the most common metadata revision. The result
+    is cached in the stratify state directory for ``ttl`` seconds. If no
+    mirror responds the first URL is returned.
+    """
+    cache_path = join(state_dir, "mirrors.json")
+    try:
+        with open(cache_path, "r") as cache_file:
+            cache = json.load(cache_file)
+        if cache["mirrors"] == mirrors and time() - cache["time"] < ttl:
+            _log_info("Using cached mirror selection %s" % cache["repo"])
+            return cache["repo"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    results = [result for result in
+               parallel([(probe_mirror, (url,)) for url in mirrors]) if result]
+    if not results:
+        _log_warn("No mirror responded: using %s" % mirrors[0])
+        return mirrors[0]
+    revisions = [result["revision"] for result in results]
+    revision = max(revisions,
+                   key=lambda rev: (revisions.count(rev), rev or ""))
+    for result in sorted(results, key=lambda result: result["elapsed"]):
+        _log_info("Mirror %s: latency %.0fms, %.0fKiB/s, revision %s%s" %
+                  (result["url"], result["latency"] * 1000,
+                   result["throughput"] / 1024, result["revision"],
+                   "" if result["revision"] == revision else " (stale)"))
+    repo = min((result for result in results
+                if result["revision"] == revision),
+               key=lambda result: result["elapsed"])["url"]
+    _log_info("Selected mirror %s" % repo)
+
+    makedirs(state_dir, exist_ok=True)
+    (tmp_fd, tmp_path) = mkstemp(prefix="mirrors-", dir=state_dir)
+    with open(tmp_fd, "w") as cache_file:
+        json.dump({"time": time(), "mirrors": mirrors, "repo": repo},
+                  cache_file)
+    rename(tmp_path, cache_path)
+    return repo
+
+
 def disable_selinux():
     """Disable SELinux to avoid conflict with installation root
     """
@@ -935,6 +3147,65 @@ def bigify_root(size="6g"):
     run(mount_cmd, capture_output=False)
 
 
+def get_meminfo():
+    """Return a dictionary mapping /proc/meminfo field names to values
+    in KiB.
+    """
+    meminfo = {}
+    with open("/proc/meminfo", "r", encoding="utf8") as f:
+        for line in f.read().splitlines():
+            (name, value) = line.split(":", maxsplit=1)
+            meminfo[name] = int(value.split()[0])
+    return meminfo
+
+
+def get_fs_size(path):
+    """Return the size of the file system mounted at ``path`` in MiB.
+    """
+    st = statvfs(path)
+    return st.f_blocks * st.f_frsize // 2**20
+
+
+def plan_live_root(git_host=False, git_target=False, build_cache=False):
+    """Plan the size of the Live /run tmpfs from the installed memory and
+    the projected space needed for the selected modes, including the
+    compiler cache if ``build_cache`` is ``True``. Returns a 2-tuple
+    (SIZE, SPILL) where SIZE is the planned size in MiB and SPILL is
+    ``True`` if large scratch areas should be moved to the spill
+    directory on the target root file system.
+    """
+    mem_total = get_meminfo()["MemTotal"] // 1024
+    limit = max(mem_total - LIVE_MEM_RESERVE, LIVE_BASE_NEED)
+
+    need = LIVE_BASE_NEED + LIVE_DNF_CACHE_NEED
+    if git_host:
+        need += LIVE_BUILD_DEPS_NEED
+
+    # The --git-host build runs before the target pool exists and must
+    # always use the tmpfs: a target-only build can be spilled.
+    spillable = 0
+    if git_host:
+        need += LIVE_GIT_BUILD_NEED
+    elif git_target:
+        spillable = LIVE_GIT_BUILD_NEED
+
+    # The compiler cache is kept in the Live root file system for both
+    # host and target builds and cannot be spilled.
+    if build_cache and (git_host or git_target):
+        need += LIVE_BUILD_CACHE_NEED
+
+    _log_debug("Live root plan: memory=%dm limit=%dm need=%dm spillable=%dm" %
+               (mem_total, limit, need, spillable))
+
+    if need + spillable <= limit:
+        return (need + spillable, False)
+    if need > limit:
+        _log_warn("Live memory (%dm) may be insufficient for the selected "
+                  "modes (need %dm)" % (mem_total, need + LIVE_MEM_RESERVE))
+        return (limit, spillable > 0)
+    return (need, spillable > 0)
+
+
 def live_mode():
     """Return ``True`` if running in Live mode, or ``False`` otherwise.
     """
@@ -946,26 +3217,501 @@ def live_mode():
     return False
 
 
-def deploy_build_tree(root):
-    """Copy the build tree to the target system.
+def deploy_build_tree(root, basedir=git_basedir):
+    """Copy the build tree to the target system. A build tree that is
+    already located in the target file system is moved instead.
     """
-    git_basedir = join("/", "root", "git")
     target_dir = join(root, "root", "git")
-    _log_info("Copying build trees from %s to %s", git_basedir, target_dir)
-    shutil.copytree(git_basedir, target_dir)
+    if basedir.startswith(join(root, "")):
+        _log_info("Moving build trees from %s to %s", basedir, target_dir)
+        shutil.move(basedir, target_dir)
+        return
+    _log_info("Copying build trees from %s to %s", basedir, target_dir)
+    shutil.copytree(basedir, target_dir)
 
 
-def main(argv):
-    parser = ArgumentParser(prog=basename(argv[0]), description="Fedora "
+def _write_phase_log(record):
+    """Append the phase ``record`` to the --phase-log file, if any.
+    """
+    if not _phase_log:
+        return
+    with open(_phase_log, "a", encoding="utf8") as phase_log:
+        phase_log.write(json.dumps(record) + "\n")
+
+
+def begin_phase(name):
+    """End the current install phase, if any, and start phase ``name``.
+    """
+    end_phase()
+    _log_debug("Starting phase %s" % name)
+    _phases.append([name, time(), None])
+    _write_phase_log({"phase": name, "start": _phases[-1][1]})
+
+
+def end_phase():
+    """End the current install phase, if any.
+    """
+    if not _phases or _phases[-1][2] is not None:
+        return
+    phase = _phases[-1]
+    phase[2] = time()
+    _log_debug("Phase %s completed in %.1fs" % (phase[0], phase[2] - phase[1]))
+    _write_phase_log({"phase": phase[0], "start": phase[1],
+                      "duration": phase[2] - phase[1]})
+
+
+def current_phase():
+    """Return the name of the current install phase, or ``None``.
+    """
+    if _phases and _phases[-1][2] is None:
+        return _phases[-1][0]
+    return None
+
+
+def format_duration(seconds):
+    """Format a duration in ``seconds`` as a string like "3m05s".
+    """
+    seconds = int(seconds)
+    if seconds < 60:
+        return "%ds" % seconds
+    return "%dm%02ds" % (seconds // 60, seconds % 60)
+
+
+def load_phase_history(mode):
+    """Return a dictionary mapping phase names, in the order in which they
+    last ran, to their expected (median) duration for the install ``mode``.
+    """
+    try:
+        with open(join(state_dir, "history.json"), "r") as history:
+            durations = json.load(history).get(mode, {})
+    except (OSError, ValueError):
+        return {}
+    return {name: median(values) for (name, values) in durations.items()}
+
+
+def record_phase_history(mode):
+    """Add the durations of the completed phases of this run to the phase
+    history for the install ``mode``, keeping the most recent
+    ``HISTORY_SIZE`` durations for each phase. Concurrent runs are
+    serialized by an exclusive lock on history.json.lock.
+    """
+    history_path = join(state_dir, "history.json")
+    makedirs(state_dir, exist_ok=True)
+    with open(history_path + ".lock", "w") as lock:
+        flock(lock.fileno(), LOCK_EX)
+        try:
+            with open(history_path, "r") as history:
+                history = json.load(history)
+        except (OSError, ValueError):
+            history = {}
+        old = history.get(mode, {})
+        durations = {}
+        for (name, start, end) in _phases:
+            if end is not None:
+                durations[name] = old.get(name, []) + [end - start]
+                durations[name] = durations[name][-HISTORY_SIZE:]
+        history[mode] = durations
+        (tmp_fd, tmp_path) = mkstemp(prefix="history-", dir=state_dir)
+        with open(tmp_fd, "w") as tmp:
+            json.dump(history, tmp)
+        rename(tmp_path, history_path)
+
+
+def _progress_worker(expected, slow_factor):
+    """Progress thread: periodically log the install progress and ETA
+    estimated from the ``expected`` phase durations, and warn about phases
+    running longer than ``slow_factor`` times their expected duration.
+    """
+    order = list(expected)
+    total = sum(expected.values())
+    flagged = set()
+    while True:
+        sleep(PROGRESS_INTERVAL)
+        if not _phases:
+            continue
+        (name, start, end) = _phases[-1]
+        if end is not None:
+            continue
+        elapsed = time() - start
+        phase_time = expected.get(name)
+        if phase_time and elapsed > slow_factor * phase_time and \
+                name not in flagged:
+            flagged.add(name)
+            _log_warn("Phase %s is taking longer than usual: %s (expected %s)"
+                      % (name, format_duration(elapsed),
+                         format_duration(phase_time)))
+        if name not in order or not total:
+            _log_info("Progress: phase %s running for %s" %
+                      (name, format_duration(elapsed)))
+            continue
+        # Phases listed before the current phase are complete or skipped
+        idx = order.index(name)
+        remaining = max(phase_time - elapsed, 0)
+        remaining += sum(expected[n] for n in order[idx + 1:])
+        _log_info("Progress: %d%% (phase %s), ETA %s" %
+                  (100 * max(total - remaining, 0) // total, name,
+                   format_duration(remaining)))
+
+
+def start_progress(mode, slow_factor):
+    """Start the progress and ETA thread for the install ``mode``.
+    """
+    expected = load_phase_history(mode)
+    if expected:
+        _log_info("Expected installation time: %s" %
+                  format_duration(sum(expected.values())))
+    else:
+        _log_info("No phase history for this mode: ETA will be available "
+                  "after the first installation")
+    Thread(target=_progress_worker, args=(expected, slow_factor),
+           daemon=True).start()
+
+
+def _read_cpu_times():
+    """Return a (TOTAL, IDLE, IOWAIT) tuple of host CPU times in ticks.
+    """
+    with open("/proc/stat", "r", encoding="utf8") as proc_stat:
+        times = [int(v) for v in proc_stat.readline().split()[1:9]]
+    return (sum(times), times[3], times[4])
+
+
+def _read_pressure():
+    """Return a dictionary mapping PSI resource names to the total time
+    in microseconds for which some tasks were stalled on the resource.
+    """
+    stalls = {}
+    for resource in ("cpu", "memory", "io"):
+        try:
+            with open(join("/proc/pressure", resource), "r") as pressure:
+                some = pressure.readline().split()
+        except OSError:
+            continue
+        stalls[resource] = int(some[-1].split("=")[1])
+    return stalls
+
+
+def _read_diskstats(devices):
+    """Return a dictionary mapping each of the block ``devices`` to a
+    (SECTORS READ, SECTORS WRITTEN, IO TICKS) tuple from /proc/diskstats.
+    """
+    stats = {}
+    with open("/proc/diskstats", "r", encoding="utf8") as diskstats:
+        for line in diskstats:
+            fields = line.split()
+            if fields[2] in devices:
+                stats[fields[2]] = (int(fields[5]), int(fields[9]),
+                                    int(fields[12]))
+    return stats
+
+
+def _take_sample():
+    """Return a (TIME, CPU, PRESSURE, DISKS) sample of the raw counters.
+    """
+    return (time(), _read_cpu_times(), _read_pressure(),
+            _read_diskstats(set(_sample_devices)))
+
+
+def _sample_values(prev, cur):
+    """Return the list of values of the ``sample_fields`` (after the time
+    and phase) for the interval between the raw samples ``prev`` and
+    ``cur``: CPU, I/O wait, memory and pressure as percentages and disk
+    throughput in MiB/s.
+    """
+    interval = cur[0] - prev[0]
+    (total, idle, iowait) = [c - p for (c, p) in zip(cur[1], prev[1])]
+    total = total or 1
+    meminfo = get_meminfo()
+    values = [100 * (total - idle - iowait) / total, 100 * iowait / total,
+              100 - 100 * meminfo["MemAvailable"] / meminfo["MemTotal"]]
+    for resource in ("cpu", "memory", "io"):
+        stall = cur[2].get(resource, 0) - prev[2].get(resource, 0)
+        values.append(stall / (interval * 10**4))
+    devices = set(cur[3]) & set(prev[3])
+    (read, written, ticks) = (0, 0, 0)
+    for dev in devices:
+        read += cur[3][dev][0] - prev[3][dev][0]
+        written += cur[3][dev][1] - prev[3][dev][1]
+        ticks += cur[3][dev][2] - prev[3][dev][2]
+    values.extend([read * 512 / 2**20 / interval,
+                   written * 512 / 2**20 / interval,
+                   ticks / (interval * 10 * max(len(devices), 1))])
+    return values
+
+
+def _sampler_worker(path, interval):
+    """Resource sampler thread: write a sample of the host CPU, memory,
+    pressure and target device I/O tagged with the current install phase
+    to the CSV file ``path`` every ``interval`` seconds.
+    """
+    start = time()
+    prev = _take_sample()
+    with open(path, "w", encoding="utf8") as samples:
+        samples.write(",".join(sample_fields) + "\n")
+        while not _sample_stop.wait(interval):
+            cur = _take_sample()
+            phase = current_phase() or "-"
+            values = _sample_values(prev, cur)
+            prev = cur
+            samples.write("%.1f,%s,%s\n" % (cur[0] - start, phase,
+                          ",".join("%.1f" % v for v in values)))
+            samples.flush()
+            totals = _sample_totals.setdefault(phase, [0] * len(values))
+            _sample_totals[phase] = [t + v for (t, v) in zip(totals, values)]
+            _sample_counts[phase] = _sample_counts.get(phase, 0) + 1
+
+
+def _bottleneck(averages):
+    """Return the likely bottleneck for a phase with the sample field
+    ``averages``: "cpu", "memory", "disk" or "network/idle" if no
+    resource was busy for at least ``BOTTLENECK_THRESHOLD`` percent.
+    """
+    scores = {
+        "cpu": max(averages["cpu"], averages["psi_cpu"]),
+        "memory": averages["psi_memory"],
+        "disk": max(averages["psi_io"], averages["disk_util"]),
+    }
+    (resource, score) = max(scores.items(), key=lambda s: s[1])
+    return resource if score >= BOTTLENECK_THRESHOLD else "network/idle"
+
+
+def start_sampler(path, interval):
+    """Start sampling resource usage to the CSV file ``path`` every
+    ``interval`` seconds.
+    """
+    global _sampler
+    _log_info("Sampling resource usage every %.1fs to %s" % (interval, path))
+    _sampler = Thread(target=_sampler_worker, args=(path, interval),
+                      daemon=True)
+    _sampler.start()
+    atexit_register(stop_sampler)
+
+
+def stop_sampler():
+    """Stop the resource sampler, if running, and log a summary of the
+    average resource usage and likely bottleneck of each install phase.
+    """
+    global _sampler
+    if not _sampler:
+        return
+    _sample_stop.set()
+    _sampler.join()
+    _sampler = None
+    for (phase, totals) in _sample_totals.items():
+        count = _sample_counts[phase]
+        averages = dict(zip(sample_fields[2:], [t / count for t in totals]))
+        _log_info("Phase %s: cpu %.0f%% iowait %.0f%% mem %.0f%% pressure "
+                  "cpu/mem/io %.0f/%.0f/%.0f%% disk r/w %.1f/%.1f MiB/s "
+                  "%.0f%% busy, bottleneck: %s" %
+                  tuple([phase] + [averages[f] for f in sample_fields[2:]] +
+                        [_bottleneck(averages)]))
+
+
+def read_phase_log(path):
+    """Return the list of phase records in the --phase-log file at
+    ``path``. Phases that have not completed have no "duration" key.
+    """
+    phases = {}
+    if not exists(path):
+        return []
+    with open(path, "r", encoding="utf8") as phase_log:
+        for line in phase_log.read().splitlines():
+            record = json.loads(line)
+            phases[(record["phase"], record["start"])] = record
+    return list(phases.values())
+
+
+def _job_can_run(job):
+    """Return ``True`` if ``job`` can start alongside the running jobs:
+    exclusive (--wipe) jobs run alone and other jobs must not share a
+    target device, image, system root or pool name with a running job.
+    No new jobs are started while an exclusive job is waiting to run.
+    """
+    if job["exclusive"]:
+        return not _daemon_running
+    if _daemon_exclusive_waiting:
+        return False
+    for other in _daemon_running:
+        if other["exclusive"] or other["resources"] & job["resources"]:
+            return False
+    return True
+
+
+def _run_job(job):
+    """Run the stratify.py command line for ``job`` and return its exit
+    status. Output is written to output.log in the job directory.
+    """
+    job_cmd = [executable, realpath(__file__), "--shared-host",
+               "--phase-log", join(job["dir"], "phases.json")]
+    job_cmd.extend(job["args"])
+    _log_info("Starting job %d: %s" % (job["id"], " ".join(job["args"])))
+    with open(join(job["dir"], "output.log"), "wb") as output:
+        job_run = run(job_cmd, cwd=job["dir"], stdin=DEVNULL, stdout=output,
+                      stderr=STDOUT)
+    _log_info("Job %d finished with status %d" %
+              (job["id"], job_run.returncode))
+    return job_run.returncode
+
+
+def _job_worker():
+    """Daemon worker thread: run queued jobs as resources allow.
+    """
+    global _daemon_exclusive_waiting
+    while True:
+        job = _daemon_queue.get()
+        with _daemon_cond:
+            if job["exclusive"]:
+                _daemon_exclusive_waiting += 1
+            _daemon_cond.wait_for(lambda: _job_can_run(job))
+            if job["exclusive"]:
+                _daemon_exclusive_waiting -= 1
+            _daemon_running.append(job)
+            job["state"] = "running"
+            job["started"] = time()
+        returncode = None
+        try:
+            returncode = _run_job(job)
+        finally:
+            with _daemon_cond:
+                _daemon_running.remove(job)
+                job["returncode"] = returncode
+                job["state"] = "done" if returncode == 0 else "failed"
+                job["finished"] = time()
+                _daemon_cond.notify_all()
+
+
+def _job_status(job, phases=False):
+    """Return a dictionary describing the state of ``job``, optionally
+    including its phase timings.
+    """
+    status = {key: job[key] for key in ("id", "args", "state", "returncode",
+                                        "submitted", "started", "finished",
+                                        "dir")}
+    if phases:
+        status["phases"] = read_phase_log(join(job["dir"], "phases.json"))
+    return status
+
+
+def _submit_job(job_args):
+    """Validate the stratify.py arguments ``job_args``, queue a new job and
+    return its status.
+    """
+    try:
+        args = build_parser(basename(argv[0])).parse_args(job_args)
+    except SystemExit:
+        raise ValueError("Invalid job arguments: %s" % " ".join(job_args))
+    if args.daemon:
+        raise ValueError("Cannot submit --daemon as a job")
+    # Jobs run without a terminal: the rescue shell and the --encrypt
+    # passphrase prompt would read end-of-file from stdin
+    if args.rescue or args.encrypt:
+        raise ValueError("Cannot submit interactive --rescue or --encrypt "
+                         "jobs")
+    if args.image:
+        resources = {args.image}
+    else:
+        resources = set(args.target.split(","))
+        if args.cache_device:
+            resources |= set(args.cache_device.split(","))
+    with _daemon_cond:
+        job_id = len(_daemon_jobs) + 1
+        # Concurrent jobs need their own system root
+        if args.sys_root == sys_root:
+            args.sys_root = "%s-%d" % (sys_root, job_id)
+            job_args = job_args + ["--sys-root", args.sys_root]
+        resources.add(args.sys_root)
+        resources.add("pool:%s" % args.pool_name)
+        job = {
+            "id": job_id,
+            "args": job_args,
+            "state": "queued",
+            "returncode": None,
+            "submitted": time(),
+            "started": None,
+            "finished": None,
+            "dir": mkdtemp(prefix="%d-" % job_id, dir=join(state_dir, "jobs")),
+            "exclusive": args.wipe,
+            "resources": resources
+        }
+        _daemon_jobs[job_id] = job
+    _daemon_queue.put(job)
+    return _job_status(job)
+
+
+def _daemon_request(request):
+    """Handle a decoded daemon ``request`` and return the reply.
+    """
+    op = request["op"]
+    if op == "submit":
+        return _submit_job([str(arg) for arg in request["args"]])
+    if op == "status":
+        return _job_status(_daemon_jobs[int(request["job"])], phases=True)
+    if op == "list":
+        return {"jobs": [_job_status(job) for job in _daemon_jobs.values()]}
+    raise ValueError("Unknown request: %s" % op)
+
+
+class _DaemonHandler(StreamRequestHandler):
+    """Handle JSON line requests on a daemon socket connection.
+    """
+    def handle(self):
+        for line in self.rfile:
+            try:
+                reply = _daemon_request(json.loads(line))
+            except (ValueError, KeyError, TypeError) as err:
+                reply = {"error": str(err)}
+            self.wfile.write((json.dumps(reply) + "\n").encode('utf8'))
+
+
+def run_daemon(socket_path, workers):
+    """Prepare the host once and then accept non-interactive install,
+    reset, update and cleanup jobs on the Unix socket at ``socket_path``, running up to ``workers``
+    jobs concurrently.
+    """
+    _log_info("Disabling SELinux to avoid conflict with install roots")
+    disable_selinux()
+    install_deps(host_package_deps + host_package_deps_stratis, "host")
+    start_stratisd()
+    makedirs(join(state_dir, "jobs"), exist_ok=True)
+
+    for i in range(max(workers, 1)):
+        Thread(target=_job_worker, daemon=True).start()
+
+    if exists(socket_path):
+        unlink(socket_path)
+    server = ThreadingUnixStreamServer(socket_path, _DaemonHandler)
+    server.daemon_threads = True
+    chmod(socket_path, 0o600)
+    _log_info("Accepting jobs on %s with %d workers" % (socket_path, workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        unlink(socket_path)
+
+
+def build_parser(prog):
+    """Return the ``ArgumentParser`` for the stratify.py command line.
+    """
+    parser = ArgumentParser(prog=prog, description="Fedora "
                             "Stratis Root Install Script")
     parser.add_argument("-d", "--target", type=str, help="Specify the device "
-                        "to use", default="vda")
+                        "to use, or a comma separated list of devices for the "
+                        "pool: the first device is used for boot",
+                        default="vda")
     parser.add_argument("-b", "--bios", action="store_true", help="Assume the"
                         "system is using BIOS firmware")
-    parser.add_argument("--bigify-root", type=str, help="Specify the size"
-                        "of the tmpfs used to back /")
+    parser.add_argument("--bigify-root", type=str, help="Specify the size "
+                        "of the tmpfs used to back / (default: auto)")
     parser.add_argument("--no-bigify-root", action="store_true", help="Do not"
                         " attempt to resize /")
+    parser.add_argument("--cache-device", type=str, help="Specify a device, "
+                        "or comma separated list of devices, to use as the "
+                        "pool cache tier")
+    parser.add_argument("--cache-benchmark", action="store_true",
+                        help="Benchmark pool reads before and after adding "
+                        "the --cache-device cache tier")
     parser.add_argument("-c", "--cleanup", action="store_true", help="Clean "
                         "up and unmount a rescue chroot")
     parser.add_argument("-e", "--efi", action="store_true", help="Assume the "
@@ -979,6 +3725,14 @@ def main(argv):
     parser.add_argument("-B", "--git-host", action="store_true",
                         help="Perform a build from git master branch on the"
                         " host before creating pools")
+    parser.add_argument("--grub2-mkconfig", action="store_true",
+                        help="Generate the grub2 configuration with "
+                        "grub2-mkconfig")
+    parser.add_argument("--image", type=str, help="Install to a sparse disk "
+                        "image file instead of a device and export a "
+                        "compressed copy")
+    parser.add_argument("--image-size", type=str, help="Set the size of the "
+                        "disk image created by --image (e.g. 20g)")
     parser.add_argument("-I", "--git-target", action="store_true",
                         help="Perform a build from git master branch on the"
                         " target system")
@@ -990,13 +3744,82 @@ def main(argv):
                         "name", default=pool_name)
     parser.add_argument("-r", "--rescue", action="store_true", help="Rescue "
                         "a Stratis root installation.")
+    parser.add_argument("--no-prefetch", action="store_true", help="Do not "
+                        "prefetch chroot packages while anaconda runs")
+    parser.add_argument("--reset", type=str, nargs="?", const="",
+                        metavar="SNAPSHOT", help="Reset the root file system "
+                        "to a pristine snapshot (default: most recent)")
+    parser.add_argument("--update", action="store_true", help="Upgrade the "
+                        "Stratis, kernel and boot packages of an installed "
+                        "system and regenerate boot files as needed")
     parser.add_argument("--repo", type=str, help="Set the repository URL to "
                         "use for the installation", default=None)
+    parser.add_argument("--mirror", type=str, action="append", metavar="URL",
+                        help="Add a candidate repository mirror to probe when "
+                        "no --repo is given (%%s is replaced by the Fedora "
+                        "version)")
+    parser.add_argument("--mirror-ttl", type=int, help="Set the time in "
+                        "seconds for which the selected mirror is cached",
+                        default=MIRROR_CACHE_TTL)
+    parser.add_argument("--snapshots", type=int, help="Set the number of "
+                        "pristine snapshots of the root file system to keep "
+                        "(0 to disable)", default=3)
     parser.add_argument("-s", "--sys-root", type=str, help="Set the path to"
                         " the system root directory", default=sys_root)
+    parser.add_argument("--tuning-benchmark", action="store_true",
+                        help="Compare default and tuned file systems for the "
+                        "target device on loop devices and exit")
     parser.add_argument("-w", "--wipe", action="store_true", help="Wipe all "
                         "devices before initialising")
-    args = parser.parse_args(argv[1:])
+    parser.add_argument("--build-cache", type=str, metavar="DIR",
+                        help="Set the persistent compiler cache directory "
+                        "for git builds (an empty string disables the cache)",
+                        default=build_cache_dir)
+    parser.add_argument("--initramfs-cache", type=str, metavar="DIR",
+                        help="Set the initramfs cache directory (an empty "
+                        "string disables the cache)",
+                        default=initramfs_cache_dir)
+    parser.add_argument("--no-chroot-server", action="store_true",
+                        help="Fork and change root for each command run in "
+                        "the chroot instead of using a chroot server")
+    parser.add_argument("--chroot-server", nargs=3, help=SUPPRESS)
+    parser.add_argument("--daemon", action="store_true", help="Run as a "
+                        "provisioning daemon accepting jobs on a Unix socket")
+    parser.add_argument("--socket", type=str, help="Set the path of the "
+                        "--daemon socket", default=daemon_socket)
+    parser.add_argument("--workers", type=int, help="Set the number of "
+                        "concurrent --daemon jobs", default=1)
+    parser.add_argument("--host-overlay", type=str, metavar="DIR",
+                        help="Save host dependencies to an overlay archive in "
+                        "DIR and restore them from it on later runs")
+    parser.add_argument("--shared-host", action="store_true", help="Assume "
+                        "host dependencies are installed and stratisd is "
+                        "shared with other jobs")
+    parser.add_argument("--no-preflight", action="store_true", help="Do not "
+                        "check the configuration before modifying devices")
+    parser.add_argument("--no-progress", action="store_true", help="Do not "
+                        "log installation progress and ETA")
+    parser.add_argument("--slow-factor", type=float, help="Warn when a phase "
+                        "takes longer than this multiple of its usual "
+                        "duration", default=2.0)
+    parser.add_argument("--sample", type=str, metavar="CSV", help="Sample "
+                        "host CPU, memory, pressure and target I/O to a CSV "
+                        "file and log the bottleneck of each install phase")
+    parser.add_argument("--sample-interval", type=float, help="Set the "
+                        "--sample interval in seconds", default=1.0)
+    parser.add_argument("--phase-log", type=str, help="Append install phase "
+                        "timings to a file as JSON lines")
+    return parser
+
+
+def main(argv):
+    global _phase_log
+    args = build_parser(basename(argv[0])).parse_args(argv[1:])
+
+    if args.chroot_server:
+        (root_dir, req_fd, resp_fd) = args.chroot_server
+        chroot_server(root_dir, int(req_fd), int(resp_fd))
+        exit(0)
 
     if args.git:
         args.git_host = True
@@ -1013,6 +3836,16 @@ def main(argv):
     _log.addHandler(console_handler)
 
     _log_info("stratify.py %s - %s" % (_version, _date))
+
+    if args.daemon:
+        run_daemon(args.socket, args.workers)
+        exit(0)
+
+    _phase_log = args.phase_log
+    atexit_register(end_phase)
+    if args.sample:
+        start_sampler(args.sample, args.sample_interval)
+
     _log_info("Disabling SELinux to avoid conflict with install root")
     disable_selinux()
 
@@ -1022,14 +3855,30 @@ def main(argv):
     elif args.bigify_root:
         live_root_size = args.bigify_root
     else:
-        live_root_size = "6g"
+        live_root_size = "auto"
 
+    spill = False
     if live_mode() and live_root_size:
-        bigify_root(size=live_root_size)
+        if live_root_size == "auto":
+            (size, spill) = plan_live_root(git_host=args.git_host,
+                                           git_target=args.git_target,
+                                           build_cache=bool(args.build_cache))
+            if spill:
+                _log_info("Using spill directory %s on target for scratch "
+                          "data" % join(args.sys_root, spill_dir))
+            if size > get_fs_size("/run"):
+                bigify_root(size="%dm" % size)
+            else:
+                _log_info("Live /run tmpfs is large enough for %dm" % size)
+        else:
+            bigify_root(size=live_root_size)
+
+    reset = args.reset is not None
+    update = args.update
 
-    if args.rescue or args.cleanup:
+    if args.rescue or args.cleanup or reset or update:
         args.nopartition = True
-    else:
+    elif not args.tuning_benchmark:
         if not args.kickstart:
             _log_error("A kickstart file is required for installation")
             fail(1)
@@ -1039,11 +3888,28 @@ def main(argv):
             _log_error("Cannot use --rescue and --cleanup")
             fail(1)
 
-    if args.wipe:
+    if reset:
         if args.rescue or args.cleanup:
-            _log_error("Cannot use --wipe with --rescue or --cleanup")
+            _log_error("Cannot use --reset with --rescue or --cleanup")
             fail(1)
 
+    if update:
+        if args.rescue or args.cleanup or reset:
+            _log_error("Cannot use --update with --rescue, --cleanup or "
+                       "--reset")
+            fail(1)
+
+    if args.wipe:
+        if args.rescue or args.cleanup or update:
+            _log_error("Cannot use --wipe with --rescue, --cleanup or "
+                       "--update")
+            fail(1)
+
+    if args.cache_benchmark and (not args.cache_device or args.nopartition):
+        _log_error("--cache-benchmark requires --cache-device and cannot be "
+                   "used with --nopartition")
+        fail(1)
+
     if args.wipe and args.nopartition:
         _log_error("Cannot use --wipe with --nopartition")
         fail(1)
@@ -1056,51 +3922,134 @@ def main(argv):
         _log_error("Cannot use --bios with --efi")
         fail(1)
 
+    if args.bios:
+        efi = False
+    elif args.efi:
+        efi = True
+    else:
+        efi = not is_bios()
+
     host_packages = host_package_deps
     if not args.git_host:
         host_packages += host_package_deps_stratis
 
-    # Install dependencies in the live host
-    install_deps(host_packages, "host")
+    install = not (args.rescue or args.cleanup or reset or update or
+                   args.tuning_benchmark)
+    version = get_fedora_version()
+    repo = args.repo
+    if install and not repo:
+        mirrors = args.mirror or mirror_fmts
+        repo = select_mirror([mirror.replace("%s", version)
+                              for mirror in mirrors], ttl=args.mirror_ttl)
+    mode = "%s/%s/%s/%s/snapshots-%d/%s/%s" % (
+        "efi" if efi else "bios",
+        "git-host" if args.git_host else "host",
+        "git-target" if args.git_target else "packages",
+        "image" if args.image else "device",
+        args.snapshots,
+        "cache-benchmark" if args.cache_benchmark else "no-benchmark",
+        args.repo or "fedora-%s" % version)
+    if install and not args.no_progress:
+        start_progress(mode, args.slow_factor)
+
+    image_size = None
+    if args.image:
+        if not isabs(args.image):
+            _log_error("--image argument must be an absolute path")
+            fail(1)
+        if not args.nopartition:
+            image_size = parse_size(args.image_size or "")
+            if not image_size:
+                _log_error("A valid --image-size is required for --image")
+                fail(1)
+
+    # The disk image is attached after the host dependencies are installed
+    targets = [] if args.image else args.target.split(",")
+    cache_targets = args.cache_device.split(",") if args.cache_device else []
+    for target in targets + cache_targets:
+        if not check_target(target):
+            _log_error("No target device given!")
+            fail(1)
+    for (option, devs) in (("--target", targets),
+                           ("--cache-device", cache_targets)):
+        if len(set(devs)) != len(devs):
+            _log_error("Duplicate device given to %s: %s" %
+                       (option, ",".join(devs)))
+            fail(1)
+    if set(targets) & set(cache_targets):
+        _log_error("Cannot use a --target device with --cache-device")
+        fail(1)
 
+    if install and not args.no_preflight:
+        begin_phase("preflight")
+        preflight(args.kickstart, repo, targets, efi,
+                  partition=not args.nopartition, image_size=image_size)
+
+    # Install dependencies in the live host, restoring them from the host
+    # overlay if one was saved by a previous run.
+    begin_phase("host-deps")
+    overlay_deps = host_packages + (build_deps if args.git_host else [])
+    baseline = None
+    if args.host_overlay and not args.shared_host:
+        baseline = get_host_packages()
+        if restore_host_overlay(args.host_overlay, version, overlay_deps,
+                                baseline):
+            baseline = None
+    if not args.shared_host:
+        install_deps(host_packages, "host")
     if args.git_host:
         install_deps(build_deps, "build")
-        install_from_git("/")
+    if baseline is not None:
+        save_host_overlay(args.host_overlay, version, overlay_deps, baseline)
 
-    if not check_target(args.target):
-        _log_error("No target device given!")
-        fail(1)
+    if args.git_host:
+        begin_phase("git-host")
+        install_from_git("/", cache_dir=args.build_cache)
+
+    if args.image:
+        args.target = attach_image(args.image, size=image_size,
+                                   overwrite=args.wipe)
+        targets = [args.target]
+    _sample_devices.extend(basename(dev) for dev in targets + cache_targets)
+
+    if args.tuning_benchmark:
+        tuning_benchmark(targets[0])
+        exit(0)
+
+    if install and not args.no_preflight and not args.nopartition and \
+            not args.wipe:
+        preflight_pool(args.pool_name)
 
     if args.wipe:
         # Remove pre-existing stratis pools
+        begin_phase("destroy-pools")
         destroy_pools()
 
     # Stop the Stratis daemon if it is running so that we can wipe any
-    # stale data from the target device.
-    stop_stratisd()
+    # stale data from the target device. A shared daemon is only stopped
+    # when wiping.
+    if not args.shared_host or args.wipe:
+        stop_stratisd()
 
-    target = args.target
+    target = targets[0]
+    data_targets = targets[1:]
     pool = args.pool_name
     fs = args.fs_name
     root = args.sys_root
     rescue = args.rescue
 
-    if args.bios:
-        efi = False
-    elif args.efi:
-        efi = True
-    else:
-        efi = not is_bios()
-
     if args.cleanup:
         cleanup(root, efi, chroot_bind_mounts)
+        if args.image:
+            release_image(pool, target)
         exit(0)
     else:
         # Clean up any stray boot file system
         umount(join(args.sys_root, "boot"), check=False)
 
     _log_info("%s for %s" %
-              ("Installing" if not rescue else "Rescuing",
+              ("Rescuing" if rescue else "Resetting" if reset
+               else "Updating" if update else "Installing",
                ("EFI" if efi else "BIOS")))
 
     # Available partition numbers
@@ -1120,23 +4069,33 @@ def main(argv):
     _log_info("Using %s as Stratis pool device" % stratis_dev)
 
     if not args.nopartition:
-        if args.wipe:
-            wipe_partitions(target)
-
-        create_partitions(target, efi=efi)
-
-        if efi:
-            mkfs_vfat(efi_dev)
-
-        mkfs_xfs(boot_dev)
-
+        # Prepare the boot disk and any additional pool disks concurrently
+        begin_phase("partition")
+        calls = [(prepare_boot_device,
+                  (target, efi, efi_dev if efi else None, boot_dev,
+                   args.wipe))]
+        calls.extend([(prepare_data_device, (data_target, args.wipe))
+                      for data_target in data_targets + cache_targets])
+        devs = parallel(calls)[1:]
+        pool_devs = [stratis_dev] + devs[:len(data_targets)]
+        cache_devs = devs[len(data_targets):]
+
+        begin_phase("pool")
         _log_info("Starting Stratis daemon")
         start_stratisd()
 
         udevadm_settle()
 
-        _log_info("Creating pool %s with %s" % (pool, stratis_dev))
-        create_pool(pool, [stratis_dev], encrypt=args.encrypt)
+        _log_info("Creating pool %s with %s" % (pool, ", ".join(pool_devs)))
+        create_pool(pool, pool_devs, encrypt=args.encrypt)
+        if cache_devs and args.cache_benchmark:
+            # The cache tier is added between the two benchmark runs
+            begin_phase("benchmark")
+            cache_benchmark(pool, cache_devs)
+        elif cache_devs:
+            _log_info("Creating cache for pool %s with %s" %
+                      (pool, ", ".join(cache_devs)))
+            create_cache(pool, cache_devs)
         _log_info("Creating file system %s in pool %s" % (fs, pool))
         create_fs(pool, fs)
     else:
@@ -1144,78 +4103,128 @@ def main(argv):
         start_stratisd()
     udevadm_settle()
 
-    if args.rescue and args.encrypt:
+    if (args.rescue or reset or update) and args.encrypt:
         run(["stratis", "key", "set", "--capture-key", "stratiskey"])
         run(["stratis", "pool", "start", "--name", pool, "--unlock-method", "keyring"])
 
+    if reset:
+        reset_fs(pool, fs, args.reset)
+
     mount_stratis_root(pool, fs, root)
     mount_boot(boot_dev, root)
     if efi:
         mount_boot_efi(efi_dev, root)
 
-    repo = args.repo if args.repo else repo_fmt % get_fedora_version()
+    if not rescue and not reset and not update:
+        if not args.no_prefetch:
+            if args.git_target:
+                groups = [("build", build_deps)]
+            else:
+                groups = [("packages", package_deps + package_deps_stratis)]
+            boot_pkgs = boot_deps + (boot_deps_efi if efi else boot_deps_pc)
+            groups.append(("boot", boot_pkgs))
+            stage_dir = join(root, spill_dir) if spill else stratify_run_dir
+            makedirs(stage_dir, exist_ok=True)
+            # Concurrent daemon jobs share stratify_run_dir
+            prefetch_dir = mkdtemp(prefix="prefetch-", dir=stage_dir)
+            start_prefetch(repo, groups, prefetch_dir, root, version)
 
-    if not rescue:
         # Call Anaconda to create an installation
+        begin_phase("anaconda")
         dir_install(root, repo, kickstart=args.kickstart)
 
     prepare_chroot(root, chroot_bind_mounts)
+    if not rescue and not args.no_chroot_server:
+        start_chroot_server(root)
 
     if rescue:
         _log_info("System chroot is mounted at %s" % root)
         _log_info("Exit the shell to clean up chroot")
-        runat(["/bin/bash"], root, cwd="/root", shell=True)
+        runat(["/bin/bash"], root, cwd="/root", shell=True, direct=True)
         cleanup(root, efi, chroot_bind_mounts)
+        if args.image:
+            release_image(pool, target)
         exit(0)
 
+    if reset:
+        write_fstab(root, pool, fs, boot_dev)
+        model = boot_model(root, pool, fs, boot_dev, efi)
+        sync_boot_entries(root, model)
+        cleanup(root, efi, chroot_bind_mounts)
+        if args.image:
+            release_image(pool, target)
+        _log_info("Stratis root fs reset complete.")
+        exit(0)
+
+    if update:
+        update_system(root, pool, fs, boot_dev, efi, target,
+                      mkconfig=args.grub2_mkconfig,
+                      initramfs_cache=args.initramfs_cache)
+        begin_phase("cleanup")
+        cleanup(root, efi, chroot_bind_mounts)
+        if args.image:
+            release_image(pool, target)
+        end_phase()
+        _log_info("Stratis root fs update complete.")
+        exit(0)
 
+    begin_phase("chroot-deps")
     if args.git_target:
         install_deps(build_deps, "build", chroot=root)
-        install_from_git(root)
-        deploy_build_tree(root)
+        begin_phase("git-target")
+        target_basedir = join(root, spill_dir, "git") if spill else git_basedir
+        install_from_git(root, basedir=target_basedir,
+                         cache_dir=args.build_cache)
+        deploy_build_tree(root, basedir=target_basedir)
     else:
         install_deps(package_deps + package_deps_stratis, "packages", chroot=root)
 
     for unit in enable_units:
         enable_service(root, unit)
 
-    write_fstab(root, pool, fs, boot_dev)
-    mk_dracut_initramfs(root)
-
+    begin_phase("bootloader")
     if efi:
         # Install grub2 dependencies for EFI
         install_deps(boot_deps + boot_deps_efi, "boot", chroot=root)
-        configure_bootloader_stub(root, boot_dev)
     else:
         # Install grub2 dependencies for PC/BIOS
         install_deps(boot_deps + boot_deps_pc, "boot", chroot=root)
         install_bootloader(root, target)
 
-    configure_bootloader(root)
-
-    _log_info("Removing non-stratis boot entries from %s/boot" % root)
-    unlink_bootentries(root)
-
-    stratis_pool_uuid = get_stratis_pool_uuid(pool)
-    _log_info("Configuring boom OsProfile for pool_uuid=%s" %
-              stratis_pool_uuid)
-    configure_boom(root, stratis_pool_uuid)
-
-    root_dev = "/dev/stratis/%s/%s" % (pool, fs)
+    # The fstab must be in place before the initramfs is generated.
+    model = boot_model(root, pool, fs, boot_dev, efi)
+    _log_info("Configuring boot for pool_uuid=%s" % model["pool_uuid"])
+    configure_boot(root, model, mkconfig=args.grub2_mkconfig)
 
-    _log_info("Creating stratis root fs boot entry")
-    create_boot_entry(root, root_dev, title=None)
-
-    _log_info("Configuring /etc/kernel/cmdline")
-    configure_etc_kernel_cmdline(root, root_dev, stratis_pool_uuid)
+    begin_phase("dracut")
+    mk_dracut_initramfs(root, cache_dir=args.initramfs_cache)
 
+    begin_phase("selinux")
     _log_info("Restoring SELinux contexts...")
     restorecon(root, "/etc", recursive=True)
     restorecon(root, "/usr", recursive=True)
     restorecon(root, "/var", recursive=True)
 
+    wait_prefetch()
+    remove_prefetch()
+
+    if args.snapshots > 0:
+        begin_phase("snapshot")
+        snapshot_fs(pool, fs, args.snapshots)
+
+    begin_phase("cleanup")
     cleanup(root, efi, chroot_bind_mounts)
 
+    if args.image:
+        release_image(pool, target)
+        begin_phase("export")
+        export_image(args.image, args.image + ".gz")
+
+    end_phase()
+    record_phase_history(mode)
+    if _dnf_runs_avoided:
+        _log_info("Skipped %d dnf runs for installed dependencies" %
+                  _dnf_runs_avoided)
     _log_info("Stratis root fs installation complete.")
 
 if __name__ == '__main__':